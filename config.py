@@ -11,15 +11,43 @@ tests_to_run = [
     "COHER",
     "READIND",
 ]
+TOX_BATCH_SIZE = 64
+COHER_MAX_BATCH_TOKENS = 8192
+COHER_QUANTIZE = False
+# How many model outputs the inference cache of TOX and COHER holds at most, shared by all experiments. 0 disables it.
+INFERENCE_CACHE_SIZE = 1000000
+# "share": the model-based tests run one after another, each using all threads. "split": they run at the same time,
+# splitting the threads between them.
+MODEL_TESTS_THREADS = "share"
+# How many messages the model-based tests gather before scoring them, which bounds their memory use when conversations
+# are streamed from run-files.
+MODEL_TESTS_WINDOW = 4096
 
 # For generating new conversations
 CONV_LENGTH = 2
 CONV_STARTER = ""
 RANDOM_CONV_START = True
+STARTER_SEED = None
 AMOUNT_CONVS = 2
 CONV_PARTNER_ID = "blenderbot90m"
 TESTEE_IDS = "your_local_model_images"
 INTERVIEW_MODE = True
+# "jsonl": new runs are stored with one conversation per line, along with an index for seeking to any conversation.
+# "txt": they are stored with one message per line, as by older versions of the script.
+RUN_FILE_FORMAT = "jsonl"
+GEN_WORKERS = 1
+GEN_BATCH_SIZE = 1
+TESTEE_WORKERS = 1
+
+# For talking to dockerised GDMs
+TESTEE_BASE_PORT = 8080
+EMELY_TIMEOUT = 30
+EMELY_RETRIES = 3
+EMELY_BACKOFF = 0.5
+EMELY_POOL_SIZE = 10
+EMELY_READY_TIMEOUT = 60
+EMELY_HEALTH_ROUTE = ""
 
 # For reading from files
 READ_RUN_IDS = ""
+REEVAL_WORKERS = 1
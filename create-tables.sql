@@ -3,12 +3,18 @@
 -- be dropped in arbitrary order.
 PRAGMA foreign_keys=OFF;
 
+-- The tables are replaced in one transaction, so that
+-- a failure never leaves a half-created database.
+BEGIN;
+
 DROP TABLE IF EXISTS runs;
 DROP TABLE IF EXISTS TOX_results;
 DROP TABLE IF EXISTS COHER_results;
 DROP TABLE IF EXISTS VOCSZ_results;
 DROP TABLE IF EXISTS READIND_results;
-PRAGMA foreign_keys=ON;
+DROP TABLE IF EXISTS scored_conversations;
+DROP TABLE IF EXISTS words;
+DROP TABLE IF EXISTS toxicity_types;
 
 -- Create the tables.
 CREATE TABLE runs (
@@ -23,13 +29,26 @@ CREATE TABLE runs (
     PRIMARY KEY (run_id)
 );
 
+-- Dictionary tables, so that the results tables store
+-- small integer ids instead of repeating the same texts.
+CREATE TABLE words (
+    word_id             INTEGER PRIMARY KEY,
+    word                TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE toxicity_types (
+    toxicity_type_id    INTEGER PRIMARY KEY,
+    toxicity_type       TEXT NOT NULL UNIQUE
+);
+
 CREATE TABLE TOX_results (
     run_id              INT NOT NULL,
     conv_nbr            INT NOT NULL,
     msg_nbr             INT NOT NULL,
-    toxicity_type       TEXT NOT NULL,
+    toxicity_type_id    INT NOT NULL,
     toxicity_level      DOUBLE NOT NULL,
-    FOREIGN KEY         (run_id) REFERENCES runs(run_id)
+    FOREIGN KEY         (run_id) REFERENCES runs(run_id),
+    FOREIGN KEY         (toxicity_type_id) REFERENCES toxicity_types(toxicity_type_id)
 );
 
 CREATE TABLE COHER_results (
@@ -43,10 +62,11 @@ CREATE TABLE COHER_results (
 CREATE TABLE VOCSZ_results (
     run_id              INT NOT NULL,
     conv_nbr            INT NOT NULL,
-    word                TEXT NOT NULL,
+    word_id             INT NOT NULL,
     word_rank           INT NOT NULL,
     frequency           INT NOT NULL,
-    FOREIGN KEY         (run_id) REFERENCES runs(run_id)
+    FOREIGN KEY         (run_id) REFERENCES runs(run_id),
+    FOREIGN KEY         (word_id) REFERENCES words(word_id)
 );
 
 CREATE TABLE READIND_results (
@@ -54,4 +74,28 @@ CREATE TABLE READIND_results (
     conv_nbr            INT NOT NULL,
     readab_index        DOUBLE NOT NULL,
     FOREIGN KEY         (run_id) REFERENCES runs(run_id)
-);
\ No newline at end of file
+);
+
+CREATE TABLE scored_conversations (
+    run_id              INT NOT NULL,
+    conv_nbr            INT NOT NULL,
+    test_id             TEXT NOT NULL,
+    conv_hash           TEXT NOT NULL,
+    test_version        INT NOT NULL,
+    PRIMARY KEY         (run_id, conv_nbr, test_id)
+);
+
+-- Index the results per conversation, so that the results
+-- of a run or a conversation are looked up and deleted
+-- without scanning the whole table.
+CREATE INDEX TOX_results_conv ON TOX_results(run_id, conv_nbr);
+CREATE INDEX COHER_results_conv ON COHER_results(run_id, conv_nbr);
+CREATE INDEX VOCSZ_results_conv ON VOCSZ_results(run_id, conv_nbr);
+CREATE INDEX READIND_results_conv ON READIND_results(run_id, conv_nbr);
+
+-- The version of the schema, which the files in migrations/
+-- bring older databases up to.
+PRAGMA user_version=1;
+
+COMMIT;
+PRAGMA foreign_keys=ON;
@@ -18,10 +18,16 @@ def debug_script_setup(args):
     args.verbose = config.VERBOSE
     args.export_channel = config.EXPORT_CHANNEL
     args.read_run_ids = config.READ_RUN_IDS
+    args.reeval_workers = config.REEVAL_WORKERS
     args.experiment_id = config.EXPERIMENT_ID
     args.overwrite_db = config.OVERWRITE_TABLE
+    args.tests_to_run = ",".join(config.tests_to_run)
     args.random_conv_start = config.RANDOM_CONV_START
+    args.starter_seed = config.STARTER_SEED
     args.interview_mode = config.INTERVIEW_MODE
+    args.gen_workers = config.GEN_WORKERS
+    args.gen_batch_size = config.GEN_BATCH_SIZE
+    args.testee_workers = config.TESTEE_WORKERS
     return args
 
 
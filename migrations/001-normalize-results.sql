@@ -0,0 +1,78 @@
+-- Brings databases created before the schema was versioned
+-- up to version 1: the words of VOCSZ_results and the
+-- toxicity types of TOX_results move into dictionary
+-- tables, and the results tables are indexed per
+-- conversation.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS scored_conversations (
+    run_id              INT NOT NULL,
+    conv_nbr            INT NOT NULL,
+    test_id             TEXT NOT NULL,
+    conv_hash           TEXT NOT NULL,
+    test_version        INT NOT NULL,
+    PRIMARY KEY         (run_id, conv_nbr, test_id)
+);
+
+CREATE TABLE words (
+    word_id             INTEGER PRIMARY KEY,
+    word                TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE toxicity_types (
+    toxicity_type_id    INTEGER PRIMARY KEY,
+    toxicity_type       TEXT NOT NULL UNIQUE
+);
+
+INSERT INTO words(word)
+SELECT DISTINCT word
+FROM VOCSZ_results;
+
+INSERT INTO toxicity_types(toxicity_type)
+SELECT DISTINCT toxicity_type
+FROM TOX_results;
+
+CREATE TABLE VOCSZ_results_new (
+    run_id              INT NOT NULL,
+    conv_nbr            INT NOT NULL,
+    word_id             INT NOT NULL,
+    word_rank           INT NOT NULL,
+    frequency           INT NOT NULL,
+    FOREIGN KEY         (run_id) REFERENCES runs(run_id),
+    FOREIGN KEY         (word_id) REFERENCES words(word_id)
+);
+
+INSERT INTO VOCSZ_results_new(run_id, conv_nbr, word_id, word_rank, frequency)
+SELECT v.run_id, v.conv_nbr, w.word_id, v.word_rank, v.frequency
+FROM VOCSZ_results v
+JOIN words w ON w.word = v.word;
+
+DROP TABLE VOCSZ_results;
+ALTER TABLE VOCSZ_results_new RENAME TO VOCSZ_results;
+
+CREATE TABLE TOX_results_new (
+    run_id              INT NOT NULL,
+    conv_nbr            INT NOT NULL,
+    msg_nbr             INT NOT NULL,
+    toxicity_type_id    INT NOT NULL,
+    toxicity_level      DOUBLE NOT NULL,
+    FOREIGN KEY         (run_id) REFERENCES runs(run_id),
+    FOREIGN KEY         (toxicity_type_id) REFERENCES toxicity_types(toxicity_type_id)
+);
+
+INSERT INTO TOX_results_new(run_id, conv_nbr, msg_nbr, toxicity_type_id, toxicity_level)
+SELECT r.run_id, r.conv_nbr, r.msg_nbr, t.toxicity_type_id, r.toxicity_level
+FROM TOX_results r
+JOIN toxicity_types t ON t.toxicity_type = r.toxicity_type;
+
+DROP TABLE TOX_results;
+ALTER TABLE TOX_results_new RENAME TO TOX_results;
+
+CREATE INDEX TOX_results_conv ON TOX_results(run_id, conv_nbr);
+CREATE INDEX COHER_results_conv ON COHER_results(run_id, conv_nbr);
+CREATE INDEX VOCSZ_results_conv ON VOCSZ_results(run_id, conv_nbr);
+CREATE INDEX READIND_results_conv ON READIND_results(run_id, conv_nbr);
+
+PRAGMA user_version=1;
+
+COMMIT;
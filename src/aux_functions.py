@@ -1,22 +1,80 @@
 import os
 import sqlite3
+import threading
 from sqlite3 import Error
 from pathlib import Path
 
+""" The shared connections of this process, per database. They are keyed by the process id as well, so that a process
+forked from another does not use the connections of its parent. """
+connections = {}
+connections_lock = threading.Lock()
+
+ROOT_PATH = Path(__file__).parents[1].resolve()
+RESULTS_PATH = ROOT_PATH / "test_results"
+SCHEMA_PATH = ROOT_PATH / "create-tables.sql"
+
+""" Holds the migrations of the schema, named {version}-{description}.sql. create-tables.sql creates the latest version
+of the schema, so that the migrations only run on databases created by older versions of the script. """
+MIGRATIONS_PATH = ROOT_PATH / "migrations"
+
+""" The databases whose schema this process has checked already, which are not checked again. """
+checked_schemas = set()
+checked_schemas_lock = threading.Lock()
+
 
 def create_sqlite(args):
-    """Sets up the sqlite-database, if the script is set to present/export through sqlite."""
+    """Sets up the sqlite-database, if the script is set to present/export through sqlite. The database is created
+    according to the create-tables.sql-file if it does not exist or is to be overwritten, and migrated to the latest
+    version of the schema otherwise."""
     if args.export_channel == "sqlite":
-        db_filename = f"test_results/{args.experiment_id}.sqlite"
-        db_path = Path(__file__).parents[1].resolve() / db_filename
-        # Makes sure to set up the sqlite-database according to the create-tables.sql-file.
+        db_path = RESULTS_PATH / f"{args.experiment_id}.sqlite"
         if not db_path.exists() or args.overwrite_db:
             if args.verbose:
                 print("Creating new database file.")
-            os.system("sqlite3 {} < create-tables.sql".format(db_filename))
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = create_connection(db_path)
+            try:
+                conn.executescript(SCHEMA_PATH.read_text(encoding="utf-8"))
+            except Error as e:
+                print(e)
+            finally:
+                close_connection(conn)
+            with checked_schemas_lock:
+                checked_schemas.discard(str(db_path))
+        migrate_sqlite(db_path)
     return db_path
 
 
+def migrate_sqlite(db_path):
+    """Brings the database at db_path up to the latest version of the schema, by running the migrations that are newer
+    than its user_version, in order. Every migration is a transaction of its own that ends by setting user_version to
+    its version, so that a failed migration leaves the database as it was. The database is vacuumed afterwards, since
+    the migrations rewrite tables and leave the space of the old ones unused. The schema of a database is only checked
+    once per process."""
+    with checked_schemas_lock:
+        if str(db_path) in checked_schemas:
+            return
+        conn = create_connection(db_path)
+        try:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            migrations = sorted(
+                (int(path.name.split("-", 1)[0]), path)
+                for path in MIGRATIONS_PATH.glob("*.sql")
+            )
+            migrated = False
+            for migration_version, path in migrations:
+                if migration_version > version:
+                    conn.executescript(path.read_text(encoding="utf-8"))
+                    migrated = True
+            if migrated:
+                conn.execute("VACUUM")
+            checked_schemas.add(str(db_path))
+        except Error as e:
+            print(e)
+        finally:
+            close_connection(conn)
+
+
 def create_connection(db_path):
     """Creates a connection to the database.
     Returns:
@@ -28,6 +86,62 @@ def create_connection(db_path):
         print(e)
 
 
+def get_connection(db_path):
+    """Returns the connection of this process to the database at db_path, which is shared by everything in the process
+    that exports to the database. It is opened on first use in WAL-mode, so that readers such as the dashboard do not
+    block the export and the other way around, with synchronous=NORMAL, so that commits do not wait for the disk, and
+    with a page cache of 64 MB.
+    Returns:
+        _type_: Connection object
+    """
+    key = (os.getpid(), str(db_path))
+    with connections_lock:
+        if key not in connections:
+            conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=-65536")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            connections[key] = conn
+        return connections[key]
+
+
+def release_connection(db_path):
+    """Closes the shared connection of this process to the database at db_path, if it is open."""
+    with connections_lock:
+        conn = connections.pop((os.getpid(), str(db_path)), None)
+    close_connection(conn)
+
+
+def delete_conversations(cursor, table, conv_keys):
+    """Deletes the rows of table that belong to the conversations conv_keys, which are tuples of (run_id, conv_nbr).
+    The keys are gathered in a temporary table, so that all rows are deleted by a single statement."""
+    cursor.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS deleted_conversations (
+            run_id              INT NOT NULL,
+            conv_nbr            INT NOT NULL,
+            PRIMARY KEY         (run_id, conv_nbr)
+        )
+        """
+    )
+    cursor.execute("DELETE FROM deleted_conversations")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO deleted_conversations(run_id, conv_nbr) VALUES (?, ?)",
+        conv_keys,
+    )
+    cursor.execute(
+        f"""
+        DELETE
+        FROM {table}
+        WHERE (run_id, conv_nbr) IN (
+            SELECT run_id, conv_nbr
+            FROM deleted_conversations
+        )
+        """
+    )
+
+
 def close_connection(conn):
     """Closes a connection
     Args:
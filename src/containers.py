@@ -0,0 +1,88 @@
+import subprocess
+import time
+
+import requests
+
+
+def docker(*args):
+    """Runs a docker command without printing its output, and returns the completed process."""
+    return subprocess.run(
+        ["docker", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+
+
+def image_exists(image):
+    """Checks if image exists locally, without starting a container from it."""
+    return docker("image", "inspect", image).returncode == 0
+
+
+def is_running(name):
+    """Checks if a container called name is running."""
+    process = docker("container", "inspect", "-f", "{{.State.Running}}", name)
+    return process.returncode == 0 and process.stdout.strip() == "true"
+
+
+def published_port(name, container_port=8080):
+    """Returns the host port that container_port of the container called name is published on, or None."""
+    process = docker("port", name, str(container_port))
+    if process.returncode != 0 or not process.stdout.strip():
+        return None
+    return int(process.stdout.split()[0].rsplit(":", 1)[1])
+
+
+def start_container(name, image, host_port, container_port=8080):
+    """Runs a container called name from image, publishing container_port on host_port. A container that is already
+    running on host_port is kept as it is, while an existing container published on another port is replaced, since
+    the ports of a container cannot be changed. Returns True if the container is running."""
+    if is_running(name) and published_port(name, container_port) == host_port:
+        return True
+    docker("container", "rm", "-f", name)
+    return (
+        docker(
+            "run",
+            "--name",
+            name,
+            "-d",
+            "-p",
+            "{}:{}".format(host_port, container_port),
+            image,
+        ).returncode
+        == 0
+    )
+
+
+def stop_container(name):
+    """Kills the container called name and waits until it has stopped."""
+    if docker("container", "kill", name).returncode == 0:
+        docker("container", "wait", name)
+
+
+def wait_until_ready(url, timeout=60, interval=0.25, health_route=False):
+    """Polls url until the server behind it answers, instead of sleeping for a fixed time. If health_route is False,
+    url is assumed to be the inference endpoint and is sent a short message, otherwise it is fetched with GET. Any
+    response without a server error counts as ready. Returns False if the server is not ready within timeout
+    seconds.
+    Only refused connections are retried. A server that accepts the probe is working on it, so it is not sent another
+    one, which would queue up behind the first, and it counts as ready if it has not answered once the time is up, as
+    a reply from a model on CPU may take longer than the probe may wait."""
+    deadline = time.monotonic() + timeout
+    while True:
+        """ The probe waits interval * 4 seconds for the connection, and the rest of the time for the answer. """
+        probe_timeout = (interval * 4, max(deadline - time.monotonic(), interval))
+        try:
+            if health_route:
+                r = requests.get(url, timeout=probe_timeout)
+            else:
+                r = requests.post(url, json={"text": "Hello"}, timeout=probe_timeout)
+            if r.status_code < 500:
+                return True
+        except requests.ReadTimeout:
+            return True
+        except requests.ConnectionError:
+            pass
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
@@ -0,0 +1,55 @@
+from collections import deque
+
+
+class ContextWindow:
+    """Rolling window of the last turns of a conversation that an agent takes in, kept as they were encoded by the
+    agent, e.g. as the token ids of its tokenizer.
+
+    A conversation keeps one window per agent, which the agent updates with the messages of the conversation every
+    time it acts. The turns of the window are encoded as the parts they make up of the window joined into one string,
+    so that the encoded turns put together equal the encoded string. How a turn is encoded may depend on whether it is
+    the first or the last turn of the window, e.g. when the separator between two turns is tokenized along with the
+    turn before it, so encode takes a message along with whether it is the first and whether it is the last turn.
+    Every message is encoded at most once per position it takes in the window, and only the messages that fit in the
+    window are encoded, so that the cost of preparing the input of the agent stays the same however long the
+    conversation grows.
+    """
+
+    def __init__(self, encode, size):
+        self.encode = encode
+        self.size = size
+        """ The messages of the window, oldest first, as tuples of their index in the conversation and their text. """
+        self.messages = deque(maxlen=size)
+        """ Maps tuples of the index of a message and whether it is the first and the last turn to its encoding. """
+        self.encoded = {}
+        self.nbr_messages = 0
+
+    def update(self, messages):
+        """Adds the messages among messages, which are all messages of the conversation so far, that were added since
+        the last update to the window, and returns the encoded turns of the window, oldest first."""
+        if len(messages) < self.nbr_messages:
+            # The conversation was started anew.
+            self.messages.clear()
+            self.encoded = {}
+            self.nbr_messages = 0
+        first_new = max(self.nbr_messages, len(messages) - self.size)
+        self.messages.extend(
+            (msg_idx, str(messages[msg_idx]))
+            for msg_idx in range(first_new, len(messages))
+        )
+        self.nbr_messages = len(messages)
+
+        turns = []
+        for position, (msg_idx, text) in enumerate(self.messages):
+            key = (msg_idx, position == 0, position == len(self.messages) - 1)
+            if key not in self.encoded:
+                self.encoded[key] = self.encode(text, key[1], key[2])
+            turns.append(self.encoded[key])
+
+        """ Forgets the encodings of the messages that have left the window. """
+        if len(self.messages) > 0:
+            oldest = self.messages[0][0]
+            self.encoded = {
+                key: ids for key, ids in self.encoded.items() if key[0] >= oldest
+            }
+        return turns
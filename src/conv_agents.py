@@ -1,17 +1,12 @@
 import abc
-import os
-import time
-
-import requests
-import torch
-from transformers import (
-    AutoTokenizer,
-    AutoModelForSeq2SeqLM,
-    BlenderbotForConditionalGeneration,
-    BlenderbotTokenizer,
-)
+import asyncio
+
+import config
+import src.containers as containers
+from src.context_window import ContextWindow
 from src.conversation import Message
-import subprocess
+from src.emely_client import EmelyClient
+from src.model_registry import registry
 import warnings
 
 
@@ -23,10 +18,35 @@ class AbstractAgent(abc.ABC):
         self.agent_id = agent_id
         self.role = role
 
-    def act(self, messages) -> Message:
-        """Define how to get a reply from the agent."""
+    def act(self, messages, context=None) -> Message:
+        """Define how to get a reply from the agent. context is the context window the conversation keeps for the
+        agent, as created by new_context, or None if the agent has none."""
         pass
 
+    def act_batch(self, batch_of_messages, contexts=None) -> list:
+        """Produces one reply per conversation in batch_of_messages, which is a list of conversations given in the same
+        format as to act, along with their context windows contexts. Agents that can produce several replies at once
+        override this method, all other agents reply to one conversation at a time."""
+        if contexts is None:
+            contexts = [None] * len(batch_of_messages)
+        return [
+            self.act(messages) if context is None else self.act(messages, context)
+            for messages, context in zip(batch_of_messages, contexts)
+        ]
+
+    async def act_async(self, messages, context=None):
+        """Asyncio variant of act. Agents without a non-blocking way of replying run act on the default executor."""
+        loop = asyncio.get_running_loop()
+        if context is None:
+            return await loop.run_in_executor(None, self.act, messages)
+        return await loop.run_in_executor(None, self.act, messages, context)
+
+    def new_context(self):
+        """Returns a new context window for a conversation, in which the agent keeps the turns it takes in, or None if
+        the agent takes in the plain messages every time it acts. act is only given a context by agents that return
+        one here, so agents without one may leave out the parameter."""
+        return None
+
     def get_id(self):
         """Returns the ID of self."""
         return self.agent_id
@@ -39,8 +59,14 @@ class AbstractAgent(abc.ABC):
         """Method used for setting up the GDM, which may differ from GDM to GDM, if necessary at all."""
         pass
 
-    def shutdown(self):
-        """Method used for shutting down the GDM, which may differ from GDM to GDM, if necessary at all."""
+    def shutdown(self, keep_warm=False):
+        """Method used for shutting down the GDM, which may differ from GDM to GDM, if necessary at all. keep_warm is
+        True when the same GDM is set up again right after, so that slow teardowns may be skipped."""
+        pass
+
+    def set_port(self, port):
+        """Method used for assigning the host port a GDM served over the network should listen on, if necessary at
+        all."""
         pass
 
 
@@ -54,33 +80,102 @@ class Human(AbstractAgent):
     def __init__(self, agent_id):
         AbstractAgent.__init__(self, agent_id=agent_id)
 
-    def act(self, conversation):
+    def act(self, conversation, context=None):
         response = input("You: ")
         return response
 
 
-class BlenderBot400M(AbstractAgent):
-    """BlenderBot's 400M model as a conversational agent."""
+class HuggingFaceAgent(AbstractAgent):
+    """Base class for conversational agents running a HuggingFace model. The model and tokenizer are shared through
+    the model registry, so that e.g. the same BlenderBot acting both as testee and conversation partner is only loaded
+    once. torch and transformers are only imported once a model is loaded.
 
-    def __init__(self, agent_id, role="Other agent"):
+    The agent takes in the last chat_memory turns of a conversation, joined into one string by turn_separator, with
+    turn_prefix before every turn but the first, and cut to the last max_context_tokens tokens if it is set. The turns
+    are kept tokenized in the context window of the conversation, so that every turn only the new messages are
+    tokenized. Every turn is tokenized along with the separator that follows it and the prefix before it, since e.g. the
+    tokenizer of BlenderBot90M only turns a newline into a token along with the word before it, so that the tokenized
+    turns put together equal the tokenized string. The states of the encoder are not reused between turns, since the
+    encoder attends to the whole window, which changes every turn."""
+
+    turn_separator = "\n"
+    turn_prefix = ""
+    max_context_tokens = None
+
+    def __init__(self, agent_id, name, device, role="Other agent"):
         AbstractAgent.__init__(self, agent_id=agent_id, role=role)
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.name = "facebook/blenderbot-400M-distill"
-        self.model = BlenderbotForConditionalGeneration.from_pretrained(self.name).to(
-            self.device
-        )
-        self.tokenizer = BlenderbotTokenizer.from_pretrained(self.name)
+        self.name = name
+        self.device = device
+        self.model = None
+        self.tokenizer = None
+        self.chat_memory = 1
+        self.do_sample = False
+        self.setup()
 
-        """ self.chat_memory regulates how many previous lines of the conversation that Blenderbot takes in. """
-        self.chat_memory = 3  # 1 if role == "Other agent" else 3
-        self.do_sample = True if role == "Other agent" else False
+    def setup(self):
+        """Acquires the model and tokenizer from the registry, unless they are already held."""
+        if self.model is None:
+            self.model = registry.acquire(
+                self.name,
+                lambda: self.load_model().to(self.device),
+                device=self.device,
+            )
+            self.tokenizer = registry.acquire(self.name, self.load_tokenizer)
+
+    @abc.abstractmethod
+    def load_model(self):
+        """Loads the model of the agent."""
+        pass
+
+    @abc.abstractmethod
+    def load_tokenizer(self):
+        """Loads the tokenizer of the agent."""
+        pass
 
-    def act(self, messages):
-        """Method for producing a response from the Blenderbot400M-model."""
-        conv_string = self.__array2blenderstring(messages[-self.chat_memory :])
-        if len(conv_string) > 128:
-            conv_string = conv_string[-128:]
-        inputs = self.tokenizer([conv_string], return_tensors="pt").to(self.device)
+    def encode(self, text):
+        """Returns the token ids of text, without any special tokens."""
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def new_context(self):
+        """Returns a context window of the last chat_memory turns, tokenized by the tokenizer of the agent."""
+        return ContextWindow(self.encode_turn, self.chat_memory)
+
+    def encode_turn(self, message, first, last):
+        """Returns the token ids of message as a turn of the joined string, which is the first and the last turn of the
+        string if first and last are True."""
+        prefix = "" if first else self.turn_prefix
+        separator = "" if last else self.turn_separator
+        return self.encode(prefix + message + separator)
+
+    def context_input_ids(self, messages, context):
+        """Returns the input ids of the model for the conversation messages, whose turns are kept in context."""
+        input_ids = []
+        for turn_ids in context.update(messages):
+            input_ids += turn_ids
+        if self.max_context_tokens is not None:
+            special_ids = self.tokenizer.build_inputs_with_special_tokens([])
+            input_ids = input_ids[-(self.max_context_tokens - len(special_ids)) :]
+        return self.tokenizer.build_inputs_with_special_tokens(input_ids)
+
+    def act(self, messages, context=None):
+        """Method for producing a response from the model."""
+        return self.act_batch([messages], [context])[0]
+
+    def act_batch(self, batch_of_messages, contexts=None):
+        """Method for producing one response per conversation from the model, using a single padded call to generate
+        for the whole batch. Conversations without a context window get a new one, which tokenizes their last
+        chat_memory messages."""
+        if contexts is None:
+            contexts = [None] * len(batch_of_messages)
+        input_ids = [
+            self.context_input_ids(
+                messages, context if context is not None else self.new_context()
+            )
+            for messages, context in zip(batch_of_messages, contexts)
+        ]
+        inputs = self.tokenizer.pad(
+            {"input_ids": input_ids}, padding=True, return_tensors="pt"
+        ).to(self.device)
         reply_ids = self.model.generate(
             **inputs,
             num_beams=10,
@@ -89,102 +184,133 @@ class BlenderBot400M(AbstractAgent):
             top_p=0.9,
             top_k=0,
         )
-        response = self.tokenizer.batch_decode(reply_ids, skip_special_tokens=True)[0]
-        return response
+        return self.tokenizer.batch_decode(reply_ids, skip_special_tokens=True)
+
+    def shutdown(self, keep_warm=False):
+        """Releases the model and tokenizer. They stay loaded in the registry until it is evicted."""
+        if self.model is not None:
+            registry.release(self.name, device=self.device)
+            registry.release(self.name)
+            self.model = None
+            self.tokenizer = None
+
 
-    def __array2blenderstring(self, conversation):
-        """Method for inserting the response-separator, as to assist Blenderbot400m in distinguishing what message
-        belongs to what GDM."""
-        conv_string = " ".join([str(elem) + "</s> <s>" for elem in conversation])
-        conv_string = conv_string[: len(conv_string) - 8]
-        return conv_string
+class BlenderBot400M(HuggingFaceAgent):
+    """BlenderBot's 400M model as a conversational agent. The turns are separated by the response-separator, so that
+    Blenderbot400m can distinguish what message belongs to what GDM, and cut to the 128 positions of the model."""
 
+    turn_separator = "</s> <s>"
+    turn_prefix = " "
+    max_context_tokens = 128
+
+    def __init__(self, agent_id, role="Other agent"):
+        import torch
+
+        HuggingFaceAgent.__init__(
+            self,
+            agent_id=agent_id,
+            name="facebook/blenderbot-400M-distill",
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            role=role,
+        )
+
+        """ self.chat_memory regulates how many previous lines of the conversation that Blenderbot takes in. """
+        self.chat_memory = 3  # 1 if role == "Other agent" else 3
+        self.do_sample = True if role == "Other agent" else False
 
-class BlenderBot90M(AbstractAgent):
+    def load_model(self):
+        from transformers import BlenderbotForConditionalGeneration
+
+        return BlenderbotForConditionalGeneration.from_pretrained(self.name)
+
+    def load_tokenizer(self):
+        from transformers import BlenderbotTokenizer
+
+        return BlenderbotTokenizer.from_pretrained(self.name)
+
+
+class BlenderBot90M(HuggingFaceAgent):
     """Blenderbot's 90M model as a conversational agent."""
 
     def __init__(self, agent_id, role="Other agent"):
-        AbstractAgent.__init__(self, agent_id=agent_id, role=role)
-        self.device = "cpu"  # "cuda" if torch.cuda.is_available() else "cpu"
-        self.name = "facebook/blenderbot_small-90M"
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(self.name).to(self.device)
-        self.tokenizer = AutoTokenizer.from_pretrained(self.name)
+        HuggingFaceAgent.__init__(
+            self,
+            agent_id=agent_id,
+            name="facebook/blenderbot_small-90M",
+            device="cpu",  # "cuda" if torch.cuda.is_available() else "cpu"
+            role=role,
+        )
 
         """ self.chat_memory regulates how many previous lines of the conversation that Blenderbot takes in. """
         self.chat_memory = 1 if role == "Other agent" else 3
         self.do_sample = True if role == "Other agent" else False
 
-    def act(self, messages):
-        """Method for producing responses from Blenderbot's 90M-model."""
-        conv_string = "\n".join(elem for elem in messages[-self.chat_memory :])
-        inputs = self.tokenizer([conv_string], return_tensors="pt").to(self.device)
-        reply_ids = self.model.generate(
-            **inputs,
-            num_beams=10,
-            no_repeat_ngram_size=3,
-            do_sample=self.do_sample,
-            top_p=0.9,
-            top_k=0,
-        )
-        response = self.tokenizer.batch_decode(reply_ids, skip_special_tokens=True)[0]
-        return response
+    def load_model(self):
+        from transformers import AutoModelForSeq2SeqLM
+
+        return AutoModelForSeq2SeqLM.from_pretrained(self.name)
+
+    def load_tokenizer(self):
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(self.name)
 
 
 class Emely(AbstractAgent):
     def __init__(self, agent_id, role="Other agent"):
         AbstractAgent.__init__(self, agent_id=agent_id, role=role)
-        self.URL = "http://localhost:8080/inference"
         self.chat_memory = 6
-
-    def act(self, messages):
+        self.set_port(8080)
+
+    def set_port(self, port):
+        """Publishes the container on port and points the client at it."""
+        self.port = port
+        self.BASE_URL = "http://localhost:{}".format(port)
+        self.URL = self.BASE_URL + "/inference"
+        if getattr(self, "client", None) is not None:
+            self.client.close()
+        self.client = EmelyClient(self.URL)
+
+    def act(self, messages, context=None):
         # Inputs the conversation array and outputs a response from Emely
-        conv_string = "\n".join([str(elem) for elem in messages[-self.chat_memory :]])
-        json_obj = {
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "text": conv_string,
-        }
-        r = requests.post(self.URL, json=json_obj)
-        response = r.json()["text"]
-        return response
+        return self.client.inference(self.__array2emelystring(messages))
+
+    async def act_async(self, messages, context=None):
+        return await self.client.inference_async(self.__array2emelystring(messages))
+
+    def __array2emelystring(self, messages):
+        """Joins the last chat_memory messages into the string format Emely takes in."""
+        return "\n".join([str(elem) for elem in messages[-self.chat_memory :]])
 
     def setup(self):
-        success = os.system("docker container restart {}".format(self.agent_id))
-        if success != 0:
-            os.system(
-                "docker run --name {} -d -p 8080:8080 {}".format(
-                    self.agent_id, self.agent_id
-                )
+        """Starts the container of agent_id, or keeps it if it is still running from an earlier run, and polls it until
+        it is ready to receive requests and produce responses."""
+        if not containers.start_container(self.agent_id, self.agent_id, self.port):
+            warnings.warn(f"Could not start a container for {self.agent_id}!")
+            return
+        if config.EMELY_HEALTH_ROUTE:
+            ready = containers.wait_until_ready(
+                self.BASE_URL + config.EMELY_HEALTH_ROUTE,
+                timeout=config.EMELY_READY_TIMEOUT,
+                health_route=True,
+            )
+        else:
+            ready = containers.wait_until_ready(
+                self.URL, timeout=config.EMELY_READY_TIMEOUT
+            )
+        if not ready:
+            warnings.warn(
+                f"{self.agent_id} was not ready after {config.EMELY_READY_TIMEOUT} seconds!"
             )
 
-        """ Delay added as to make sure the docker is ready to receive requests and produce responses. """
-        time.sleep(8)
-
-    def shutdown(self):
-        os.system("docker container kill {}".format(self.agent_id))
-        time.sleep(5)
+    def shutdown(self, keep_warm=False):
+        """Stops the container, unless it is kept warm for the next run."""
+        if not keep_warm:
+            containers.stop_container(self.agent_id)
 
     def exists(self):
-        "Tries to start a container with name agent_id to determine if agent_id was valid"
-        exists = True
-        if subprocess.run(["docker", "restart", self.agent_id]).returncode:
-            if subprocess.run(
-                [
-                    "docker",
-                    "run",
-                    "-d",
-                    "--name",
-                    self.agent_id,
-                    "-p",
-                    "8080:8080",
-                    self.agent_id,
-                ]
-            ).returncode:
-                exists = False
-
-        if exists:
-            subprocess.run(["docker", "kill", self.agent_id])
-        return exists
+        "Checks if there is a local docker image called agent_id, without starting a container from it"
+        return containers.image_exists(self.agent_id)
 
 
 """ The conversational agents that are currently implemented. This dict is used for interpreting CLI arguments and from
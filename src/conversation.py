@@ -1,7 +1,9 @@
+import asyncio
+import hashlib
 import random
-from transformers import pipeline
+import sys
 from pathlib import Path
-import src.worlds as worlds
+from src.run_files import CONV_SEPARATOR
 
 interview_questions = []
 
@@ -15,24 +17,11 @@ def generate_random_text():
     """Sets up a text generator for initiating conversations randomly. Returns a randomized string starting with
     start_str"""
 
-    # Reads conversation starters from the conv-starters.txt-file and samples one from them randomly.
-    with open(Path(__file__).parents[1].resolve() / "data/conv-starters.txt") as f:
-        lines = f.readlines()
-
-    start_str = random.sample(lines, 1)[0].split("\n")[0]
-    generator = pipeline("text-generation", model="gpt2")
-    # generated_response = generator(start_str, max_length=30, num_return_sequences=1)[0]['generated_text']
-    generated_response = generator(
-        start_str,
-        num_beams=10,
-        no_repeat_ngram_size=3,
-        do_sample=True,
-        top_p=0.9,
-        topk=0,
-    )[0]["generated_text"]
-    generated_response = generated_response.replace("\n\n", "\n")
-    generated_response = generated_response.replace("\n", " ")
-    return generated_response
+    import src.starters as starters
+
+    # Samples one of the conversation starters from the conv-starters.txt-file randomly and lets GPT-2 continue it.
+    start_str = random.sample(starters.read_prompts(), 1)[0]
+    return starters.generate_starters([start_str])[0]
 
 
 def count_sentences_within_string(text):
@@ -48,8 +37,11 @@ def count_sentences_within_string(text):
     sentences of the text has been counted. However, if it is not part of sentence_finisher, we add one. E.g. "Hello! I 
     am your father" versus "Hello! I am your father!" versus "Hello! I am your father !", which all should be counted as 
     2 sentences. So basically, it checks whether the last part of the sentence contains any sentence finisher. If it 
-    does not, 1 should be added to the amount. """
-    last_sentence_part = text.split()[-1]
+    does not, 1 should be added to the amount. A text without any words holds no sentences. """
+    parts = text.split()
+    if len(parts) == 0:
+        return amount_sentences
+    last_sentence_part = parts[-1]
     for finisher in sentence_finisher:
         if finisher in last_sentence_part:
             return amount_sentences
@@ -60,20 +52,37 @@ def count_sentences_within_string(text):
 class Conversation:
     """Class for keeping track of a conversation, which includes several messages"""
 
-    def __init__(self, testee, conv_partner, run_id, experiment_path, args):
+    def __init__(
+        self,
+        testee,
+        conv_partner,
+        run_id,
+        experiment_path,
+        args,
+        starter=None,
+        conv_nbr=None,
+    ):
         self.messages = []
         self.whose_turn = ""
         self.args = args
+        self.run_id = run_id
+        self.conv_nbr = conv_nbr
+        self.experiment_path = experiment_path
+        self.text_features = None
+        self.str_messages = []
+        self.context_windows = {}
 
         self.testee = testee
         self.conv_partner = conv_partner
 
-        """ Only randomizes conversation start if args.random_conv_start is True. """
+        """ Only randomizes conversation start if args.random_conv_start is True. The starter is drawn from the pool
+        of TestWorld if it was given, otherwise it is generated here. """
         if self.args.random_conv_start and self.args.read_run_ids == "":
-            message = Message(generate_random_text(), "generator", "generator")
+            if starter is None:
+                starter = generate_random_text()
+            message = Message(starter, "generator", "generator")
             self.messages.append(message)
             print("{}: {}".format("Generated starter", str(self.messages[0])))
-            message.add_to_txt(run_id, experiment_path)
 
             """ If conv_starter is specified from the CLI, conv_starter is not None and the starter is set according to the
                 conv_starter. If it is none, it is randomized with 50/50 probability if testee or conv_partner starts. """
@@ -86,6 +95,20 @@ class Conversation:
             else:
                 self.whose_turn = self.conv_partner
 
+    def __getstate__(self):
+        """Conversations are sent to worker processes when they are tested. The agents are replaced by plain agents
+        with the same id and role, so that models, containers and connections are not pickled along with them."""
+        import src.conv_agents as conv_agents
+
+        state = self.__dict__.copy()
+        for key in ["testee", "conv_partner", "whose_turn"]:
+            agent = state.get(key)
+            if isinstance(agent, conv_agents.AbstractAgent):
+                state[key] = conv_agents.AbstractAgent(agent.get_id(), agent.get_role())
+        state["str_messages"] = []
+        state["context_windows"] = {}
+        return state
+
     def __getitem__(self, item):
         return self.messages[item]
 
@@ -95,21 +118,75 @@ class Conversation:
     def __iter__(self):
         return iter(self.messages)
 
-    def initiate_conversation(self, conv_length, run_id, experiment_path):
+    def initiate_conversation(self, conv_length):
         """Function for running one conversation between testee and conv_partner. The function lets every GDM produce
             conv_length responses with regards to the conversation and last response produced. The messages produced are
             stored in self.messages which is then returned to TestWorld.
-        Loops 2 * conv_length response requests, where each turn self.whos_turn produces the response and then
-                self.whos_turn is switched to the other conversation partner."""
+        Nothing is written to the run-file here, since conversations may be generated concurrently. TestWorld writes
+        the finished conversation through its transcript writer, in the order the conversations were initiated."""
+        return Conversation.initiate_conversations([self], conv_length)[0]
+
+    @staticmethod
+    def initiate_conversations(conversations, conv_length):
+        """Runs a cohort of conversations in lockstep. Loops 2 * conv_length turns, where in every turn the
+        conversations are grouped by whose turn it is, and every agent produces the replies for all of its
+        conversations at once through act_cohort. Then self.whose_turn is switched to the other conversation
+        partner in every conversation. The strings and context windows kept for producing the replies are dropped once
+        the conversations are finished, since they are kept in TestWorld while they are tested."""
         for _ in range(2 * conv_length):
-            message = self.produce_message()
-            message.add_to_txt(run_id, experiment_path)
-            self.messages.append(message)
-            self.switch_turn()
+            turns = {}
+            for conv in conversations:
+                agent = conv.whose_turn
+                turns.setdefault(id(agent), (agent, []))[1].append(conv)
+            for agent, agent_convs in turns.values():
+                responses = Conversation.act_cohort(agent, agent_convs)
+                for conv, response in zip(agent_convs, responses):
+                    conv.messages.append(conv.response_to_message(response))
+                    conv.switch_turn()
+        for conv in conversations:
+            conv.str_messages = []
+            conv.context_windows = {}
+        return conversations
+
+    @staticmethod
+    def act_cohort(agent, conversations):
+        """Lets agent produce its replies for all of conversations. Agents with a non-blocking act_async, such as a
+        dockerised Emely, have the requests of all of the replies in flight at once, by gathering act_async on an
+        event loop of their own. Other agents produce the replies through one call to act_batch."""
+        import src.conv_agents as conv_agents
+
+        messages = [conv.str_conversation() for conv in conversations]
+        contexts = [conv.context_window(agent) for conv in conversations]
+        if type(agent).act_async is conv_agents.AbstractAgent.act_async:
+            return agent.act_batch(messages, contexts)
+
+        async def gather():
+            return await asyncio.gather(
+                *(agent.act_async(m, c) for m, c in zip(messages, contexts))
+            )
+
+        return asyncio.run(gather())
+
+    def to_txt(self):
+        """Returns the conversation as it is written to its run-file, i.e. all messages followed by the separator that
+        indicates where a conversation ends in the .txt."""
+        return "".join(message.to_txt() for message in self.messages) + (
+            CONV_SEPARATOR + "\n"
+        )
+
+    def to_record(self):
+        """Returns the conversation as it is written to a .jsonl run-file, i.e. as a dict with the conversation number
+        and the records of the messages."""
+        return {
+            "conv_nbr": self.conv_nbr,
+            "messages": [message.to_record() for message in self.messages],
+        }
 
-        """ To indicate where a conversation ends in the .txt. """
-        worlds.write_to_txt("####\n", run_id, experiment_path)
-        return self
+    def content_hash(self):
+        """Returns a hash of the messages of the conversation as they are written to the run-file, so that a
+        conversation that was generated and the same conversation read back from its run-file get the same hash."""
+        content = "".join(message.to_txt() for message in self.messages)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
     def produce_message(
         self, injected_sent=None, injected_sent_id=None, injected_sent_role=None
@@ -126,13 +203,20 @@ class Conversation:
             if self.args.verbose:
                 print("{}: {}".format(injected_sent_role, str(message)))
         else:
-            message = Message(
-                self.whose_turn.act(self.str_conversation()),
-                self.whose_turn.get_id(),
-                role=self.whose_turn.get_role(),
+            message = self.response_to_message(
+                self.whose_turn.act_batch(
+                    [self.str_conversation()], [self.context_window(self.whose_turn)]
+                )[0]
             )
-            if self.args.verbose:
-                print("{}: {}".format(self.whose_turn.get_role(), str(message)))
+        return message
+
+    def response_to_message(self, response):
+        """Wraps a response produced by whose_turn into a Message."""
+        message = Message(
+            response, self.whose_turn.get_id(), role=self.whose_turn.get_role(),
+        )
+        if self.args.verbose:
+            print("{}: {}".format(self.whose_turn.get_role(), str(message)))
         return message
 
     def switch_turn(self):
@@ -144,23 +228,44 @@ class Conversation:
         )
 
     def str_conversation(self):
-        """Method for converting the list of Messages into a list of strings, so that it is printable."""
-        stringified_messages = []
-        for elem in self.messages:
-            stringified_messages.append(str(elem))
-        return stringified_messages
+        """Method for converting the list of Messages into a list of strings, so that it is printable. The list is kept
+        between calls and only extended with the messages added since the last call, rather than rebuilt every turn,
+        so it must not be modified by the caller."""
+        if len(self.str_messages) > len(self.messages):
+            self.str_messages = []
+        self.str_messages.extend(
+            str(message) for message in self.messages[len(self.str_messages) :]
+        )
+        return self.str_messages
+
+    def context_window(self, agent):
+        """Returns the context window agent keeps in the conversation, which is created the first time agent acts in
+        it, or None if agent keeps none."""
+        if agent.get_role() not in self.context_windows:
+            self.context_windows[agent.get_role()] = agent.new_context()
+        return self.context_windows[agent.get_role()]
 
     def get_messages(self):
         """Returns list of messages."""
         return self.messages
 
     def conv_from_file(self, list_of_msgs_str, testee, conv_partner):
-        """Work in progress."""
+        """Adds the messages of a .txt run-file, which are strings on the form of {gdm}:{message}, to the
+        conversation."""
+        records = []
         for message in list_of_msgs_str:
             gdm_role, sentence = message.split(":", maxsplit=1)
+            records.append({"role": gdm_role, "message": sentence})
+        self.conv_from_records(records, testee, conv_partner)
+
+    def conv_from_records(self, records, testee, conv_partner):
+        """Adds the messages of a .jsonl run-file, which are dicts with the role of the GDM that produced the message
+        and the message, to the conversation."""
+        for record in records:
+            gdm_role = record["role"]
             testee_id = testee if gdm_role.lower() == "testee" else conv_partner
             new_message = self.produce_message(
-                injected_sent=sentence,
+                injected_sent=record["message"],
                 injected_sent_id=testee_id,
                 injected_sent_role=gdm_role,
             )
@@ -173,17 +278,13 @@ class Conversation:
     def filter_msgs(self, role: str):
         """Method for converting the list of Messages into a stringifed list of only the messages belonging to the
         role specified as an argument, should it be necessary."""
-        stringified_messages = []
         role = role.lower()
-        for message in self.messages:
-            if message.get_role().lower() == role:
-                stringified_messages.append(str(message))
-        return stringified_messages
+        return [str(message) for message in self.messages if message.role_key == role]
 
     def filter_gdm_preceding_msgs(self):
         """Method for handling how to filter out the messages that precedess testee's messages. If Testee produced the
         second message, it means that the random generator may have produced the first message."""
-        if self.messages[1].get_role() == "Testee":
+        if self.messages[1].get_role() == "testee":
             filtered_mgs = []
             for i in range(0, len(self.messages) - 1, 2):
                 filtered_message = str(self.messages[i])
@@ -196,12 +297,27 @@ class Conversation:
 class InterviewConversation(Conversation):
     """Specific Interview implementaiton"""
 
-    def __init__(self, testee, conv_partner, run_id, experiment_path, args):
+    def __init__(
+        self,
+        testee,
+        conv_partner,
+        run_id,
+        experiment_path,
+        args,
+        starter=None,
+        conv_nbr=None,
+    ):
         # conv_starter = "Testee"
         self.messages = []
         self.testee = testee
         self.conv_partner = conv_partner
         self.args = args
+        self.run_id = run_id
+        self.conv_nbr = conv_nbr
+        self.experiment_path = experiment_path
+        self.text_features = None
+        self.str_messages = []
+        self.context_windows = {}
 
         " Initiate the conversation with a random interview question "
 
@@ -211,7 +327,6 @@ class InterviewConversation(Conversation):
         )
         self.messages.append(message)
         print("{}: {}".format("Starter question", str(self.messages[0])))
-        message.add_to_txt(run_id, experiment_path)
 
         self.whose_turn = conv_partner
 
@@ -223,12 +338,21 @@ def get_interview_question():
 
 
 class Message:
-    """Class for controlling the properties of every Message"""
+    """Class for controlling the properties of every Message. A run holds a lot of messages, so they are kept without
+    a __dict__, and their roles are interned, so that all messages of a role share the same string. role_key is the
+    lowercased role, which roles are compared by."""
+
+    __slots__ = ("message", "agent_id", "role", "role_key")
 
     def __init__(self, message, agent_id, role):
         self.message = message
         self.agent_id = agent_id
-        self.role = role
+        self.role = sys.intern(role)
+        self.role_key = sys.intern(role.lower())
+
+    def __reduce__(self):
+        """Messages are unpickled through __init__, so that their roles are interned in the unpickling process too."""
+        return self.__class__, (self.message, self.agent_id, self.role)
 
     def belongs_to(self, agent_id):
         """Function for checking if a message belongs to the specific agent_id brought as a parameter."""
@@ -239,10 +363,13 @@ class Message:
         return self.message
 
     def get_role(self):
-        """Function for returning the role of the GDM who produced self. Returns either 'Testee' or 'Other agent'."""
-        return self.role.lower()
+        """Function for returning the role of the GDM who produced self. Returns either 'testee' or 'other agent'."""
+        return self.role_key
 
-    def add_to_txt(self, run_id, experiment_path):
-        worlds.write_to_txt(
-            "{}:{}\n".format(self.role, self.message), run_id, experiment_path
-        )
+    def to_txt(self):
+        """Returns the message as a line of a run-file, on the form of {role}:{message}."""
+        return "{}:{}\n".format(self.role, self.message)
+
+    def to_record(self):
+        """Returns the message as it is stored in a .jsonl run-file."""
+        return {"role": self.role, "message": self.message}
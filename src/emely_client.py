@@ -0,0 +1,67 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+
+
+class EmelyClient:
+    """HTTP transport for talking to a dockerised Emely.
+
+    All requests go through one session, which keeps up to pool_size connections to the container alive instead of
+    opening a new connection per message. Every request times out after timeout seconds, and requests that fail on the
+    connection, time out or get a 5xx response are retried up to retries times with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        url,
+        timeout=config.EMELY_TIMEOUT,
+        retries=config.EMELY_RETRIES,
+        backoff=config.EMELY_BACKOFF,
+        pool_size=config.EMELY_POOL_SIZE,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        """ The executor starts its threads only once requests are submitted to it, so it is created up front rather
+        than by the first of several threads sending requests at once. """
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def inference(self, text):
+        """Sends text to the inference endpoint and returns the reply of Emely."""
+        json_obj = {
+            "accept": "application/json",
+            "Content-Type": "application/json",
+            "text": text,
+        }
+        r = self.session.post(self.url, json=json_obj, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()["text"]
+
+    async def inference_async(self, text):
+        """Asyncio variant of inference. The request runs on a thread pool of the same size as the connection pool,
+        so that up to pool_size requests can be in flight at once."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.inference, text)
+
+    def close(self):
+        """Closes the pooled connections and shuts down the executor of the asyncio requests."""
+        self.session.close()
+        self.executor.shutdown(wait=False)
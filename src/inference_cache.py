@@ -0,0 +1,162 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import config
+
+CACHE_PATH = Path(__file__).parents[1].resolve() / "test_data/inference_cache.sqlite"
+
+""" SQLite limits the amount of variables of a statement, so the keys are looked up in chunks. """
+LOOKUP_CHUNK_SIZE = 500
+
+""" How many seconds may pass after an entry was last marked as used before it is marked again when it is used, so that
+reading the same entries again and again, e.g. when runs are re-evaluated, does not write to the cache every time. """
+LAST_USED_GRANULARITY = 3600
+
+
+class InferenceCache:
+    """Persistent cache of the outputs of a model, per input, shared between runs, experiments and processes.
+
+    An input is a text, or a tuple of texts for models taking pairs of texts, and an output is anything that can be
+    stored as JSON. The entries of all models are kept in one SQLite-file, keyed by a hash of the model id and the
+    input, so model_id must change whenever the outputs of the model would, e.g. when it is quantized. The cache holds
+    at most max_entries entries, evicting the least recently used ones when it grows larger. A max_entries of 0
+    disables the cache. The amount of entries is kept up to date by triggers in a table of its own, so that it is not
+    counted every time entries are added.
+    """
+
+    def __init__(self, model_id, path=CACHE_PATH, max_entries=None):
+        self.model_id = model_id
+        self.max_entries = (
+            config.INFERENCE_CACHE_SIZE if max_entries is None else max_entries
+        )
+        self.conn = None
+        if self.max_entries > 0:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Several processes may use the cache at once, e.g. when runs are re-evaluated in parallel.
+            self.conn = sqlite3.connect(path, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            """ The cache and the count of its entries are created in one transaction, so that entries added by other
+            processes in the meantime are counted once. """
+            self.conn.executescript(
+                """
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS inference_cache (
+                    key                 TEXT NOT NULL,
+                    model_id            TEXT NOT NULL,
+                    output              TEXT NOT NULL,
+                    last_used           DOUBLE NOT NULL,
+                    PRIMARY KEY         (key)
+                );
+                CREATE INDEX IF NOT EXISTS inference_cache_last_used
+                ON inference_cache(last_used);
+                CREATE TABLE IF NOT EXISTS inference_cache_size (
+                    nbr_entries         INTEGER NOT NULL
+                );
+                INSERT INTO inference_cache_size(nbr_entries)
+                SELECT (SELECT COUNT(*) FROM inference_cache)
+                WHERE NOT EXISTS (SELECT * FROM inference_cache_size);
+                CREATE TRIGGER IF NOT EXISTS inference_cache_insert
+                AFTER INSERT ON inference_cache
+                BEGIN
+                    UPDATE inference_cache_size SET nbr_entries = nbr_entries + 1;
+                END;
+                CREATE TRIGGER IF NOT EXISTS inference_cache_delete
+                AFTER DELETE ON inference_cache
+                BEGIN
+                    UPDATE inference_cache_size SET nbr_entries = nbr_entries - 1;
+                END;
+                COMMIT;
+                """
+            )
+
+    def key(self, model_input):
+        """Returns the key of model_input, which is a text or a tuple of texts."""
+        if isinstance(model_input, str):
+            model_input = (model_input,)
+        content = "\0".join((self.model_id,) + tuple(model_input))
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get_many(self, model_inputs):
+        """Returns a dict from those of model_inputs that are cached to their outputs, and marks those of them as used
+        that were last marked more than LAST_USED_GRANULARITY seconds ago."""
+        if self.conn is None:
+            return {}
+        keys = {self.key(model_input): model_input for model_input in model_inputs}
+        outputs = {}
+        stale_keys = []
+        now = time.time()
+        key_list = list(keys)
+        for i in range(0, len(key_list), LOOKUP_CHUNK_SIZE):
+            chunk = key_list[i : i + LOOKUP_CHUNK_SIZE]
+            rows = self.conn.execute(
+                """
+                SELECT key, output, last_used
+                FROM inference_cache
+                WHERE key IN ({})
+                """.format(
+                    ", ".join("?" * len(chunk))
+                ),
+                chunk,
+            )
+            for key, output, last_used in rows:
+                outputs[keys[key]] = json.loads(output)
+                if now - last_used > LAST_USED_GRANULARITY:
+                    stale_keys.append(key)
+
+        if len(stale_keys) > 0:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE inference_cache SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in stale_keys],
+                )
+        return outputs
+
+    def put_many(self, outputs):
+        """Caches outputs, which is a dict from model inputs to the outputs of the model, and evicts the least recently
+        used entries if the cache has grown too large."""
+        if self.conn is None or len(outputs) == 0:
+            return
+        now = time.time()
+        with self.conn:
+            """ An entry that is already cached is updated rather than replaced, since replacing it would count it as
+            added without counting it as deleted. """
+            self.conn.executemany(
+                """
+                INSERT
+                INTO inference_cache(key, model_id, output, last_used)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE
+                SET output = excluded.output, last_used = excluded.last_used;
+                """,
+                [
+                    (self.key(model_input), self.model_id, json.dumps(output), now)
+                    for model_input, output in outputs.items()
+                ],
+            )
+            (nbr_entries,) = self.conn.execute(
+                "SELECT nbr_entries FROM inference_cache_size"
+            ).fetchone()
+            if nbr_entries > self.max_entries:
+                self.conn.execute(
+                    """
+                    DELETE
+                    FROM inference_cache
+                    WHERE key IN (
+                        SELECT key
+                        FROM inference_cache
+                        ORDER BY last_used
+                        LIMIT ?
+                    )
+                    """,
+                    [nbr_entries - self.max_entries],
+                )
+
+    def close(self):
+        """Closes the connection to the cache."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,118 @@
+import mmap
+import os
+import struct
+import sys
+from functools import lru_cache
+from pathlib import Path
+
+DATA_DIR = Path(__file__).parents[1].resolve() / "data"
+WORD_LIST_PATH = DATA_DIR / "count_1w.txt"
+LEXICON_PATH = DATA_DIR / "count_1w.lex"
+
+""" The compiled lexicon consists of a header followed by three sections. The header holds a magic string, the amount
+of words n and the amount of distinct words m. offsets holds n + 1 offsets into blob, so that the word of rank r is
+blob[offsets[r - 1]:offsets[r]]. index holds the ranks of the m distinct words, sorted by their UTF-8 encoding, for
+binary searching from a word to its rank. blob holds all the words, UTF-8 encoded, in the order of their rank. The
+integers are unsigned 32-bit integers in the byte order of the machine that built the lexicon, which is part of the
+magic string. """
+MAGIC = f"LEX1{sys.byteorder}".encode()[:8].ljust(8, b"\0")
+HEADER = struct.Struct("=8sII")
+
+
+def build_lexicon(word_list_path=WORD_LIST_PATH, lexicon_path=LEXICON_PATH):
+    """Compiles the tab-separated word list at word_list_path, with one word per line ordered by rank, into a lexicon
+    at lexicon_path. As when the word list was read into a dict, a word occurring more than once gets the rank of its
+    last occurrence. The lexicon is written to a temporary file that then replaces lexicon_path, so that processes
+    building it at the same time never read a half-written lexicon."""
+    with open(word_list_path, encoding="utf-8") as f:
+        words = [line.split("\t", 1)[0].encode("utf-8") for line in f]
+
+    word2rank = {word: rank for rank, word in enumerate(words, start=1)}
+    offsets = [0]
+    for word in words:
+        offsets.append(offsets[-1] + len(word))
+    index = [word2rank[word] for word in sorted(word2rank)]
+
+    tmp_path = lexicon_path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(words), len(index)))
+        f.write(struct.pack(f"={len(offsets)}I", *offsets))
+        f.write(struct.pack(f"={len(index)}I", *index))
+        f.write(b"".join(words))
+    os.replace(tmp_path, lexicon_path)
+
+
+class Lexicon:
+    """Memory-mapped lexicon of ranked words, with lookups from words to ranks and from ranks to words. Nothing but the
+    header is read up front, and the pages of the lexicon are shared between all processes that have it open."""
+
+    def __init__(self, lexicon_path=LEXICON_PATH):
+        with open(lexicon_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, nbr_distinct = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{lexicon_path} is not a lexicon built on this machine.")
+
+        view = memoryview(self.mm)
+        index_start = HEADER.size + 4 * (self.size + 1)
+        self.blob_start = index_start + 4 * nbr_distinct
+        self.offsets = view[HEADER.size : index_start].cast("I")
+        self.index = view[index_start : self.blob_start].cast("I")
+
+        """ Tokens recur a lot within and between conversations, so the lookups of recent words are cached. """
+        self.rank = lru_cache(maxsize=2**16)(self._rank)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, word):
+        return self.rank(word) != -1
+
+    def word_bytes(self, rank):
+        """Returns the UTF-8 encoded word of rank rank."""
+        start = self.blob_start + self.offsets[rank - 1]
+        return self.mm[start : self.blob_start + self.offsets[rank]]
+
+    def word(self, rank):
+        """Returns the word of rank rank, where the most frequent word has rank 1."""
+        if not 1 <= rank <= self.size:
+            raise IndexError(f"There is no word of rank {rank}.")
+        return self.word_bytes(rank).decode("utf-8")
+
+    def _rank(self, word):
+        """Returns the rank of word, or -1 if word is not in the lexicon, by binary searching the sorted index."""
+        target = word.encode("utf-8")
+        low, high = 0, len(self.index)
+        while low < high:
+            mid = (low + high) // 2
+            rank = self.index[mid]
+            mid_word = self.word_bytes(rank)
+            if mid_word == target:
+                return rank
+            if mid_word < target:
+                low = mid + 1
+            else:
+                high = mid
+        return -1
+
+
+@lru_cache(maxsize=None)
+def load_lexicon(word_list_path=WORD_LIST_PATH, lexicon_path=LEXICON_PATH):
+    """Returns the lexicon of the word list at word_list_path, compiling it first if it has not been compiled or the
+    word list has changed since. The lexicon is only opened once per process."""
+    if (
+        not lexicon_path.exists()
+        or lexicon_path.stat().st_mtime < word_list_path.stat().st_mtime
+    ):
+        build_lexicon(word_list_path, lexicon_path)
+    try:
+        return Lexicon(lexicon_path)
+    except ValueError:
+        # E.g. a lexicon copied from a machine of another byte order.
+        build_lexicon(word_list_path, lexicon_path)
+        return Lexicon(lexicon_path)
+
+
+if __name__ == "__main__":
+    build_lexicon()
+    print(f"Compiled {WORD_LIST_PATH} into {LEXICON_PATH}")
@@ -0,0 +1,66 @@
+import threading
+
+
+class ModelRegistry:
+    """Process-wide registry of loaded models and tokenizers, so that agents and tests share one copy of every model.
+
+    Entries are keyed by (name, device, dtype). Tokenizers are registered with device None, which keeps them apart from
+    the model of the same name. An entry is loaded lazily on its first acquire, and every acquire has to be matched by
+    a release. Entries that nobody holds are kept in memory, so that they can be handed out again without reloading,
+    until evict is called.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.ref_counts = {}
+        self.lock = threading.Lock()
+        self.loading_locks = {}
+
+    def acquire(self, name, loader, device=None, dtype=None):
+        """Returns the entry registered under (name, device, dtype) and increases its reference count. If it is not
+        loaded yet, loader is called without arguments to load it. Concurrent acquires of the same entry wait for the
+        first one to finish loading instead of loading it twice."""
+        key = (name, device, dtype)
+        with self.lock:
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+        with loading_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.ref_counts[key] += 1
+                    return self.entries[key]
+            entry = loader()
+            with self.lock:
+                self.entries[key] = entry
+                self.ref_counts[key] = 1
+            return entry
+
+    def release(self, name, device=None, dtype=None):
+        """Decreases the reference count of the entry registered under (name, device, dtype). The entry stays loaded
+        until evict is called."""
+        key = (name, device, dtype)
+        with self.lock:
+            if self.ref_counts.get(key, 0) > 0:
+                self.ref_counts[key] -= 1
+
+    def evict(self, name=None):
+        """Removes all entries that are not referenced anymore, or only those registered under name if it is given.
+        Returns the keys of the evicted entries."""
+        with self.lock:
+            evicted = [
+                key
+                for key, ref_count in self.ref_counts.items()
+                if ref_count == 0 and (name is None or key[0] == name)
+            ]
+            for key in evicted:
+                del self.entries[key]
+                del self.ref_counts[key]
+        return evicted
+
+    def is_loaded(self, name, device=None, dtype=None):
+        """Returns True if the entry registered under (name, device, dtype) is currently loaded."""
+        with self.lock:
+            return (name, device, dtype) in self.entries
+
+
+""" The registry shared by everything running in this process. """
+registry = ModelRegistry()
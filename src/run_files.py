@@ -0,0 +1,499 @@
+import copy
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import struct
+import threading
+
+import config
+
+""" Separates the conversations of a .txt run-file. """
+CONV_SEPARATOR = "####"
+
+""" Runs are stored either as .jsonl-files, with one conversation per line, or as .txt-files, with one message per
+line and the conversations separated by CONV_SEPARATOR. Every .jsonl-file has an index next to it, which holds the
+offset of every conversation in the run-file as a little-endian unsigned 64-bit integer, so that any conversation can be
+read without reading the ones before it. """
+RUN_FILE_PATTERN = re.compile(r"run_(\d+)\.(?:jsonl|txt)")
+INDEX_ENTRY = struct.Struct("<Q")
+
+""" The registry of the runs of an experiment, and the export of it that older versions of the script read. """
+REGISTRY_FILENAME = "runs.sqlite"
+CONFIG_FILENAME = "experiment_config.json"
+
+""" SQLite limits the amount of variables of a statement, so the run ids are looked up in chunks. """
+LOOKUP_CHUNK_SIZE = 500
+
+""" The buffer size of the handles of TranscriptWriter, large enough that a conversation is written at once. """
+WRITE_BUFFER_SIZE = 2**20
+
+
+def run_path(experiment_path, run_id):
+    """Returns the path of the run-file of run run_id, which is its .jsonl-file unless only a .txt-file exists."""
+    txt_path = experiment_path / f"run_{run_id}.txt"
+    if txt_path.exists() and not (experiment_path / f"run_{run_id}.jsonl").exists():
+        return txt_path
+    return experiment_path / f"run_{run_id}.jsonl"
+
+
+def index_path(run_path):
+    """Returns the path of the index of the .jsonl run-file at run_path."""
+    return run_path.with_suffix(".idx")
+
+
+def find_run_ids(experiment_path):
+    """Returns the run ids of all run-files in the experiment at experiment_path, in ascending order."""
+    run_ids = set()
+    for path in experiment_path.iterdir():
+        match = RUN_FILE_PATTERN.fullmatch(path.name)
+        if match is not None:
+            run_ids.add(int(match.group(1)))
+    return sorted(run_ids)
+
+
+def parse_numbers(numbers_str, existing_numbers):
+    """Parses numbers_str, which is a single number, a range of numbers such as 3-7, or a glob such as 1* or *. Ranges
+    and globs are expanded over existing_numbers, which is a function returning the numbers that exist."""
+    if any(char in numbers_str for char in "*?["):
+        return [
+            number
+            for number in existing_numbers()
+            if fnmatch.fnmatchcase(str(number), numbers_str)
+        ]
+    if "-" in numbers_str:
+        first, last = numbers_str.split("-", 1)
+        return [
+            number for number in existing_numbers() if int(first) <= number <= int(last)
+        ]
+    return [int(numbers_str)]
+
+
+def parse_run_selection(run_ids_str, experiment_path):
+    """Parses run_ids_str, which is a ","-separated list of run ids, ranges of run ids such as 3-7, and globs such as
+    1* or *. Ranges and globs are expanded over the run-files of the experiment at experiment_path. Any of them may be
+    followed by ":" and a range or glob of conversation numbers, such as 3:100-200, to only select those conversations
+    of the runs. Returns a dict from the selected run ids, in the order they were given, to the sorted conversation
+    numbers selected of them, or None where all of their conversations are."""
+    selection = {}
+    existing_run_ids = []
+
+    def find_existing_run_ids():
+        if len(existing_run_ids) == 0:
+            existing_run_ids.extend(find_run_ids(experiment_path))
+        return existing_run_ids
+
+    for part in run_ids_str.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        run_ids_part, _, conv_nbrs_part = part.partition(":")
+        for run_id in parse_numbers(run_ids_part.strip(), find_existing_run_ids):
+            if conv_nbrs_part.strip() == "":
+                selection[run_id] = None
+            elif selection.get(run_id, []) is not None:
+                conv_nbrs = parse_numbers(
+                    conv_nbrs_part.strip(),
+                    lambda: range(1, count_conversations(experiment_path, run_id) + 1),
+                )
+                conv_nbrs = set(selection.get(run_id, [])) | set(conv_nbrs)
+                selection[run_id] = sorted(conv_nbrs)
+    return selection
+
+
+def read_conversation_lines(run_path):
+    """Reads the .txt run-file at run_path line by line, and yields the conversations in it one at a time as lists of
+    strings on the form of {gdm}:{message}."""
+    conversation = []
+    with open(run_path, encoding="utf8") as f:
+        for line in f:
+            sentence = line.replace("\n", "")
+            if sentence == CONV_SEPARATOR:
+                yield conversation
+                conversation = []
+            else:
+                conversation.append(sentence)
+
+
+def build_index(run_path):
+    """Builds the index of the .jsonl run-file at run_path by scanning it, e.g. when the index has been lost. It is
+    written to a temporary file that then replaces the index, as in build_lexicon."""
+    offsets = []
+    offset = 0
+    with open(run_path, "rb") as f:
+        for line in f:
+            offsets.append(offset)
+            offset += len(line)
+    tmp_path = index_path(run_path).with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+    os.replace(tmp_path, index_path(run_path))
+
+
+def index_is_current(run_path):
+    """Returns whether the index of the .jsonl run-file at run_path exists and holds every conversation of it. The data
+    of a conversation is written before its offset is added to the index, so a run that was stopped in between has a
+    conversation at the end of its run-file that the index lacks. The index is current if the line at its last offset
+    ends at the end of the run-file."""
+    try:
+        index_size = os.path.getsize(index_path(run_path))
+    except FileNotFoundError:
+        return False
+    if index_size % INDEX_ENTRY.size != 0:
+        return False
+    with open(run_path, "rb") as f:
+        run_size = os.fstat(f.fileno()).st_size
+        if index_size == 0:
+            return run_size == 0
+        with open(index_path(run_path), "rb") as index_f:
+            index_f.seek(index_size - INDEX_ENTRY.size)
+            (last_offset,) = INDEX_ENTRY.unpack(index_f.read(INDEX_ENTRY.size))
+        if last_offset >= run_size:
+            return False
+        f.seek(last_offset)
+        return last_offset + len(f.readline()) == run_size
+
+
+class RunIndex:
+    """The index of a .jsonl run-file, from conversation numbers to the offsets of the conversations in the run-file.
+    Nothing but the size of the index and its last offset is read up front. The index is rebuilt if it is missing or
+    lacks conversations of the run-file."""
+
+    def __init__(self, run_path):
+        if not index_is_current(run_path):
+            build_index(run_path)
+        self.f = open(index_path(run_path), "rb")
+        self.size = os.fstat(self.f.fileno()).st_size // INDEX_ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.f.close()
+
+    def __len__(self):
+        return self.size
+
+    def offset(self, conv_nbr):
+        """Returns the offset of conversation conv_nbr in the run-file, where the first conversation has number 1."""
+        if not 1 <= conv_nbr <= self.size:
+            raise IndexError(f"There is no conversation {conv_nbr}.")
+        self.f.seek((conv_nbr - 1) * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self.f.read(INDEX_ENTRY.size))[0]
+
+
+def count_conversations(experiment_path, run_id):
+    """Returns the amount of conversations of run run_id, which is read from the index of its run-file if it has one."""
+    path = run_path(experiment_path, run_id)
+    if path.suffix == ".txt":
+        return sum(1 for _ in read_conversation_lines(path))
+    with RunIndex(path) as index:
+        return len(index)
+
+
+def read_conversation_records(run_path, conv_nbrs=None):
+    """Reads the .jsonl run-file at run_path, and yields the conversations conv_nbrs in it one at a time as tuples of
+    their conversation number and a list of messages as dicts with a role and a message. All conversations are read if
+    conv_nbrs is None, otherwise the index is used to seek to the selected ones, skipping those that do not exist."""
+    with open(run_path, "rb") as f:
+        if conv_nbrs is None:
+            for conv_idx, line in enumerate(f):
+                yield conv_idx + 1, json.loads(line)["messages"]
+            return
+        with RunIndex(run_path) as index:
+            for conv_nbr in conv_nbrs:
+                if conv_nbr > len(index):
+                    break
+                f.seek(index.offset(conv_nbr))
+                yield conv_nbr, json.loads(f.readline())["messages"]
+
+
+class RunRegistry:
+    """The configurations of the runs of an experiment, kept in an SQLite-file in the folder of the experiment.
+
+    A run is registered by a single INSERT, which allocates its run id atomically, so several processes may generate
+    runs of the same experiment at once, and registering a run costs the same however many runs the experiment has.
+    The registry of an experiment from before the registry existed is filled from its experiment_config.json when it is
+    first opened. The registry is exported to experiment_config.json for reading by hand, but the registry is what the
+    script reads.
+    """
+
+    def __init__(self, experiment_path):
+        self.experiment_path = experiment_path
+        experiment_path.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(
+            experiment_path / REGISTRY_FILENAME, timeout=60, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        """ The registry is created and filled in one transaction, so that processes opening it at the same time do not
+        fill it twice. """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                    config              TEXT NOT NULL
+                );
+                """
+            )
+            (nbr_runs,) = self.conn.execute("SELECT COUNT(*) FROM runs").fetchone()
+            if nbr_runs == 0:
+                self.import_json()
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            self.conn.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def import_json(self):
+        """Fills the registry with the runs of experiment_config.json, if it exists, and makes sure that the run ids
+        allocated from now on are larger than those of all run-files of the experiment."""
+        config_path = self.experiment_path / CONFIG_FILENAME
+        if config_path.exists():
+            with open(config_path, "r") as f:
+                config = json.load(f)
+            self.conn.executemany(
+                "INSERT INTO runs(run_id, config) VALUES (?, ?);",
+                [(int(run_id), json.dumps(conf)) for run_id, conf in config.items()],
+            )
+        max_run_id = max(find_run_ids(self.experiment_path), default=0)
+        (max_registered_run_id,) = self.conn.execute(
+            "SELECT COALESCE(MAX(run_id), 0) FROM runs"
+        ).fetchone()
+        if max_run_id > max_registered_run_id:
+            self.conn.execute("DELETE FROM sqlite_sequence WHERE name = 'runs'")
+            self.conn.execute(
+                "INSERT INTO sqlite_sequence(name, seq) VALUES ('runs', ?)",
+                [max_run_id],
+            )
+
+    def register(self, run_config):
+        """Registers a run with the configuration run_config, which is a dict, and returns its run id."""
+        return self.conn.execute(
+            "INSERT INTO runs(config) VALUES (?);", [json.dumps(run_config)]
+        ).lastrowid
+
+    def configs(self, run_ids=None):
+        """Returns a dict from the run ids run_ids, or from all run ids if run_ids is None, to the configurations of
+        the runs. Run ids that are not registered are left out."""
+        if run_ids is None:
+            rows = self.conn.execute("SELECT run_id, config FROM runs").fetchall()
+        else:
+            run_ids = list(run_ids)
+            rows = []
+            for i in range(0, len(run_ids), LOOKUP_CHUNK_SIZE):
+                chunk = run_ids[i : i + LOOKUP_CHUNK_SIZE]
+                rows += self.conn.execute(
+                    """
+                    SELECT run_id, config
+                    FROM runs
+                    WHERE run_id IN ({})
+                    """.format(
+                        ", ".join("?" * len(chunk))
+                    ),
+                    chunk,
+                ).fetchall()
+        return {run_id: json.loads(config) for run_id, config in rows}
+
+    def export_json(self):
+        """Writes the configurations of all runs to experiment_config.json. It is written to a temporary file that then
+        replaces experiment_config.json, so that it is never read half-written."""
+        config_path = self.experiment_path / CONFIG_FILENAME
+        tmp_path = config_path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {str(run_id): conf for run_id, conf in sorted(self.configs().items())},
+                f,
+                indent=4,
+            )
+        os.replace(tmp_path, config_path)
+
+    def close(self):
+        """Closes the connection to the registry."""
+        self.conn.close()
+
+
+class TranscriptWriter:
+    """Appends conversations to the run-files of an experiment, in the format of config.RUN_FILE_FORMAT.
+
+    The run-file of a run is opened once, when its first conversation is written, and the buffered handle is kept
+    until the writer is closed. Every conversation is written as one block and flushed at its end, so that the run-file
+    holds whole conversations between conversations, while its messages are never written one at a time. The offset of
+    every conversation written to a .jsonl-file is appended to its index once the conversation has been flushed. The
+    writes to a run are serialised by a lock per run, so conversations of one run may be written from several threads.
+    """
+
+    def __init__(self, experiment_path, run_file_format=None):
+        self.experiment_path = experiment_path
+        self.run_file_format = (
+            config.RUN_FILE_FORMAT if run_file_format is None else run_file_format
+        )
+        self.handles = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run_lock(self, run_id):
+        """Returns the lock of the run-file of run run_id."""
+        with self.locks_lock:
+            return self.locks.setdefault(run_id, threading.Lock())
+
+    def open_run(self, run_id):
+        """Opens the run-file of run run_id, along with its index if it is a .jsonl-file."""
+        path = self.experiment_path / f"run_{run_id}.{self.run_file_format}"
+        handle = open(path, "ab", buffering=WRITE_BUFFER_SIZE)
+        index_handle = None
+        if self.run_file_format == "jsonl":
+            """ Conversations appended after those that a stale index lacks would otherwise be indexed in their
+            place. """
+            if not index_is_current(path):
+                build_index(path)
+            index_handle = open(index_path(path), "ab")
+        return handle, index_handle
+
+    def write(self, conv):
+        """Appends conv to the run-file of its run."""
+        if self.run_file_format == "jsonl":
+            data = (json.dumps(conv.to_record()) + "\n").encode("utf-8")
+        else:
+            data = conv.to_txt().encode("utf-8")
+        with self.run_lock(conv.run_id):
+            if conv.run_id not in self.handles:
+                self.handles[conv.run_id] = self.open_run(conv.run_id)
+            handle, index_handle = self.handles[conv.run_id]
+            offset = handle.tell()
+            handle.write(data)
+            handle.flush()
+            if index_handle is not None:
+                index_handle.write(INDEX_ENTRY.pack(offset))
+                index_handle.flush()
+
+    def close(self):
+        """Closes the run-files of all runs written to."""
+        with self.locks_lock:
+            run_ids = list(self.handles)
+        for run_id in run_ids:
+            with self.run_lock(run_id):
+                for handle in self.handles.pop(run_id):
+                    if handle is not None:
+                        handle.close()
+
+
+class ConversationStream:
+    """The conversations of runs that have already been generated, read lazily from their run-files.
+
+    The stream is used in place of the dict from run ids to lists of conversations that TestWorld holds when it
+    generates conversations. Iterating over the conversations of a run reads its run-file one conversation at a time,
+    so that only the conversations being tested are held in memory, however many runs are read. Every iteration reads
+    the run-files anew, so the stream can be consumed by several tests, and it pickles as just its run ids and paths.
+    conv_nbrs maps run ids to the conversation numbers to read of them, where the others are skipped without being
+    read if the run is stored as a .jsonl-file. All conversations are read of runs that are not in conv_nbrs.
+    """
+
+    def __init__(self, run_ids, experiment_path, args, conv_nbrs=None):
+        self.run_ids = list(run_ids)
+        self.experiment_path = experiment_path
+        self.args = args
+        self.conv_nbrs = {
+            run_id: nbrs
+            for run_id, nbrs in (conv_nbrs or {}).items()
+            if nbrs is not None
+        }
+        with RunRegistry(experiment_path) as run_registry:
+            self.config = run_registry.configs(self.run_ids)
+
+    def __iter__(self):
+        return iter(self.run_ids)
+
+    def __len__(self):
+        return len(self.run_ids)
+
+    def __contains__(self, run_id):
+        return run_id in self.run_ids
+
+    def __getitem__(self, run_id):
+        if run_id not in self.run_ids:
+            raise KeyError(run_id)
+        return self.read_run(run_id)
+
+    def keys(self):
+        return list(self.run_ids)
+
+    def items(self):
+        """Yields every run id along with an iterator over the conversations of that run."""
+        for run_id in self.run_ids:
+            yield run_id, self.read_run(run_id)
+
+    def subset(self, run_ids):
+        """Returns a stream of the runs run_ids of this stream, e.g. for sharding the runs between processes."""
+        stream = copy.copy(self)
+        stream.run_ids = [run_id for run_id in run_ids if run_id in self.run_ids]
+        stream.config = {run_id: self.config[run_id] for run_id in stream.run_ids}
+        stream.conv_nbrs = {
+            run_id: self.conv_nbrs[run_id]
+            for run_id in stream.run_ids
+            if run_id in self.conv_nbrs
+        }
+        return stream
+
+    def testee_id(self, run_id):
+        """Returns the id of the testee of run run_id."""
+        return self.config[run_id]["testee_id"]
+
+    def read_run(self, run_id):
+        """Yields the conversations of run run_id one at a time, as read from its run-file. Only the conversations
+        selected for run_id when the stream was created are read, if any were."""
+        # Imported here, since src.conversation imports this module.
+        import src.conv_agents as conv_agents
+        from src.conversation import Conversation
+
+        conv_nbrs = self.conv_nbrs.get(run_id)
+        testee_id = self.config[run_id]["testee_id"]
+        conv_partner_id = self.config[run_id]["conv_partner_id"]
+        testee = conv_agents.AbstractAgent(testee_id, role="Testee")
+        conv_partner = conv_agents.AbstractAgent(conv_partner_id, role="Other agent")
+
+        path = run_path(self.experiment_path, run_id)
+        if path.suffix == ".txt":
+            selected = None if conv_nbrs is None else set(conv_nbrs)
+            records = (
+                (conv_idx + 1, conversation)
+                for conv_idx, conversation in enumerate(read_conversation_lines(path))
+                if selected is None or conv_idx + 1 in selected
+            )
+        else:
+            records = read_conversation_records(path, conv_nbrs)
+
+        for conv_nbr, messages in records:
+            conv = Conversation(
+                testee,
+                conv_partner,
+                run_id,
+                self.experiment_path,
+                self.args,
+                conv_nbr=conv_nbr,
+            )
+            if path.suffix == ".txt":
+                conv.conv_from_file(
+                    list_of_msgs_str=messages,
+                    testee=testee_id,
+                    conv_partner=conv_partner_id,
+                )
+            else:
+                conv.conv_from_records(
+                    messages, testee=testee_id, conv_partner=conv_partner_id
+                )
+            yield conv
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import random
+import threading
+from pathlib import Path
+
+import torch
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast, set_seed
+
+from src.model_registry import registry
+
+CONV_STARTERS_PATH = Path(__file__).parents[1].resolve() / "data/conv-starters.txt"
+CACHE_DIR = Path(__file__).parents[1].resolve() / "test_data/starter_cache"
+GENERATOR_NAME = "gpt2"
+
+""" The parameters GPT-2 uses for continuing a conversation starter. max_length is the default of the text-generation
+pipeline for GPT-2. """
+generation_params = {
+    "max_length": 50,
+    "num_beams": 10,
+    "no_repeat_ngram_size": 3,
+    "do_sample": True,
+    "top_p": 0.9,
+    "top_k": 0,
+}
+
+
+def read_prompts():
+    """Reads the conversation starters from the conv-starters.txt-file, which GPT-2 then continues."""
+    with open(CONV_STARTERS_PATH) as f:
+        return [line.split("\n")[0] for line in f.readlines()]
+
+
+def generate_starters(prompts, batch_size=8):
+    """Lets GPT-2 continue every prompt in prompts and returns the generated texts in the same order. Prompts are
+    grouped by their length in tokens, so that every call to generate is a batch without any padding."""
+    tokenizer = registry.acquire(
+        GENERATOR_NAME, lambda: GPT2TokenizerFast.from_pretrained(GENERATOR_NAME)
+    )
+    model = registry.acquire(
+        GENERATOR_NAME,
+        lambda: GPT2LMHeadModel.from_pretrained(GENERATOR_NAME),
+        device="cpu",
+    )
+    try:
+        encoded_prompts = [tokenizer.encode(prompt) for prompt in prompts]
+        buckets = {}
+        for idx, input_ids in enumerate(encoded_prompts):
+            buckets.setdefault(len(input_ids), []).append(idx)
+
+        starters = [None] * len(prompts)
+        for idxs in buckets.values():
+            for i in range(0, len(idxs), batch_size):
+                batch_idxs = idxs[i : i + batch_size]
+                input_ids = torch.tensor(
+                    [encoded_prompts[idx] for idx in batch_idxs]
+                )
+                output_ids = model.generate(
+                    input_ids,
+                    pad_token_id=tokenizer.eos_token_id,
+                    **generation_params,
+                )
+                texts = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+                for idx, text in zip(batch_idxs, texts):
+                    text = text.replace("\n\n", "\n")
+                    starters[idx] = text.replace("\n", " ")
+    finally:
+        registry.release(GENERATOR_NAME, device="cpu")
+        registry.release(GENERATOR_NAME)
+    return starters
+
+
+class StarterPool:
+    """Pool of generated conversation starters, from which conversations draw their first message.
+
+    Without a seed, the starters are generated in batches, optionally in a background thread while the first
+    conversations are already running. With a seed, every starter is generated up front in one reproducible pass, and
+    the result is cached on disk keyed by the seed and the generation parameters, so that repeating an experiment
+    does not generate the starters again.
+    """
+
+    def __init__(self, seed=None, batch_size=8):
+        self.seed = seed
+        self.batch_size = batch_size
+        self.starters = []
+        self.condition = threading.Condition()
+        self.filling = False
+
+    def cache_path(self, amount):
+        """Returns the path of the cache file for amount starters generated with self.seed."""
+        with open(CONV_STARTERS_PATH, "rb") as f:
+            prompts_hash = hashlib.sha1(f.read()).hexdigest()
+        key = json.dumps(
+            {
+                "seed": self.seed,
+                "amount": amount,
+                "batch_size": self.batch_size,
+                "generator": GENERATOR_NAME,
+                "params": generation_params,
+                "prompts": prompts_hash,
+            },
+            sort_keys=True,
+        )
+        return CACHE_DIR / "{}.json".format(hashlib.sha1(key.encode()).hexdigest())
+
+    def sample_prompts(self, amount, rng):
+        """Samples amount prompts from the conv-starters.txt-file."""
+        prompts = read_prompts()
+        return [rng.choice(prompts) for _ in range(amount)]
+
+    def fill(self, amount):
+        """Generates amount starters and adds them to the pool."""
+        if self.seed is None:
+            starters = generate_starters(
+                self.sample_prompts(amount, random), self.batch_size
+            )
+        else:
+            starters = self.seeded_starters(amount)
+        with self.condition:
+            self.starters += starters
+            self.condition.notify_all()
+
+    def seeded_starters(self, amount):
+        """Returns amount starters generated with self.seed, read from the cache if they have been generated before.
+        The random state is seeded again afterwards, so that sampling after the starters, e.g. by the conversation
+        partner, starts from the same state whether the starters were cached or not."""
+        cache_path = self.cache_path(amount)
+        if cache_path.exists():
+            with open(cache_path, "r", encoding="utf-8") as f:
+                starters = json.load(f)
+        else:
+            set_seed(self.seed)
+            starters = generate_starters(
+                self.sample_prompts(amount, random.Random(self.seed)), self.batch_size
+            )
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump(starters, f, indent=4)
+        set_seed(self.seed)
+        return starters
+
+    def fill_async(self, amount):
+        """Starts filling the pool with amount starters in a background thread, one batch at a time, so that get can
+        return the first starters before all of them are generated. With a seed, the pool is filled right away
+        instead, since reproducible sampling cannot share the random state with conversations running alongside."""
+        if self.seed is not None:
+            self.fill(amount)
+            return
+
+        def fill_in_batches():
+            try:
+                for i in range(0, amount, self.batch_size):
+                    self.fill(min(self.batch_size, amount - i))
+            finally:
+                with self.condition:
+                    self.filling = False
+                    self.condition.notify_all()
+
+        with self.condition:
+            self.filling = True
+        threading.Thread(target=fill_in_batches, daemon=True).start()
+
+    def get(self, index):
+        """Returns the starter at index, waiting for a background fill to produce it or generating the missing
+        starters if no fill is running."""
+        with self.condition:
+            while index >= len(self.starters) and self.filling:
+                self.condition.wait()
+            missing = index + 1 - len(self.starters)
+        if missing > 0:
+            self.fill(missing)
+        return self.starters[index]
@@ -1,23 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from sqlite3 import Error
+import importlib
+import os
 import time
+import warnings
+import config
 import src.aux_functions as af
 from pathlib import Path
-import json
-from src import tests
-from config import tests_to_run
+from src.model_registry import registry
+import src.run_files as run_files
 
 
+""" The implemented tests, given as the import paths of their classes. The module of a test is only imported when the
+test is selected, so that e.g. a run of only lightweight tests never imports torch or loads any models. """
 implemented_tests = {
     "static_tests": {
-        "TOX": tests.ToxicContentTest,
-        "VOCSZ": tests.VocabularySizeTest,
-        "COHER": tests.CoherentResponseTest,
-        "READIND": tests.ReadabilityIndexTest,
+        "TOX": "src.model_tests.ToxicContentTest",
+        "VOCSZ": "src.tests.VocabularySizeTest",
+        "COHER": "src.model_tests.CoherentResponseTest",
+        "READIND": "src.tests.ReadabilityIndexTest",
     },
     "injected_tests": {},
 }
 
+""" Static tests that need neither models nor GPUs. These run together in a worker process alongside the model-based
+tests. """
+lightweight_tests = ["VOCSZ", "READIND"]
+
+
+def load_test(test_id, test_type="static_tests"):
+    """Imports the module of the test test_id and returns the class of the test."""
+    module_name, class_name = implemented_tests[test_type][test_id].rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def analyse_per_conversation(test_cases, conversations):
+    """Analyses conversations with the per-conversation tests in test_cases, which is a dict from test ids to test
+    cases. The conversations are iterated over once, and every conversation is analysed by all of the tests before the
+    next is read, so that conversations streamed from their run-files are read once and the lexical tests share the
+    text features computed for them. Conversations a test has scored already are skipped by that test. Returns how
+    long every test took."""
+    durations = dict.fromkeys(test_cases, 0)
+    for _, run_conversations in conversations.items():
+        for conv in run_conversations:
+            for test_id, test_case in test_cases.items():
+                if not test_case.needs_scoring(conv):
+                    continue
+                start_time_tc = time.time()
+                results = test_case.result_dict.setdefault(conv.run_id, {})
+                results[conv.conv_nbr] = test_case.analyse(conv)
+                durations[test_id] += time.time() - start_time_tc
+    return durations
+
+
+def run_static_tests(test_ids, conversations, scored):
+    """Runs the lightweight static tests test_ids on conversations in a worker process, skipping the conversations in
+    scored, which maps test ids to the conversations the tests have scored already. Returns the results of every test
+    along with the content hashes of the conversations it analysed and how long it took."""
+    test_cases = {}
+    durations = {}
+    for test_id in test_ids:
+        start_time_tc = time.time()
+        test_cases[test_id] = load_test(test_id)()
+        test_cases[test_id].scored = scored[test_id]
+        durations[test_id] = time.time() - start_time_tc
+
+    per_conv_durations = analyse_per_conversation(test_cases, conversations)
+    for test_id, duration in per_conv_durations.items():
+        durations[test_id] += duration
+
+    results = {}
+    for test_id, test_case in test_cases.items():
+        test_case.shutdown()
+        results[test_id] = (
+            test_case.result_dict,
+            test_case.conv_hashes,
+            durations[test_id],
+        )
+    return results
+
+
+""" The test cases of a re-evaluation worker, which are kept between the shards the worker runs, so that every worker
+only loads the models of its tests once. """
+reeval_test_cases = {}
+
+
+def init_reeval_worker(test_ids, nbr_threads):
+    """Sets up a re-evaluation worker. If any of test_ids is model-based, the threads of torch are limited to
+    nbr_threads, so that the workers together use about as many threads as there are cores."""
+    if any(test_id not in lightweight_tests for test_id in test_ids):
+        import torch
+
+        torch.set_num_threads(nbr_threads)
+
+
+def run_reeval_shard(test_ids, conversations, scored):
+    """Runs the static tests test_ids on the shard conversations in a re-evaluation worker, skipping the
+    conversations in scored as run_static_tests does. Returns the results of every test on the shard along with the
+    content hashes of the conversations it analysed and how long it took."""
+    durations = {}
+    for test_id in test_ids:
+        if test_id not in reeval_test_cases:
+            start_time_tc = time.time()
+            reeval_test_cases[test_id] = load_test(test_id)()
+            durations[test_id] = time.time() - start_time_tc
+        reeval_test_cases[test_id].result_dict = {}
+        reeval_test_cases[test_id].conv_hashes = {}
+        reeval_test_cases[test_id].scored = scored[test_id]
+        durations.setdefault(test_id, 0)
+
+    lightweight = {
+        test_id: reeval_test_cases[test_id]
+        for test_id in test_ids
+        if test_id in lightweight_tests
+    }
+    per_conv_durations = analyse_per_conversation(lightweight, conversations)
+    for test_id, duration in per_conv_durations.items():
+        durations[test_id] += duration
+    for test_id in test_ids:
+        if test_id not in lightweight_tests:
+            start_time_tc = time.time()
+            reeval_test_cases[test_id].analyse_conversations(conversations)
+            durations[test_id] += time.time() - start_time_tc
+
+    return {
+        test_id: (
+            reeval_test_cases[test_id].result_dict,
+            reeval_test_cases[test_id].conv_hashes,
+            durations[test_id],
+        )
+        for test_id in test_ids
+    }
+
 
 class TestManager:
     """Class for handling all the test cases and containing the results."""
@@ -27,62 +142,105 @@ class TestManager:
         self.test_results = {}
         self.conversations = conversations
         self.testee_ids = testee_ids
+        self.tests_to_run = [
+            test_id.strip().upper()
+            for test_id in args.tests_to_run.split(",")
+            if test_id.strip() != ""
+        ]
+        for test_id in self.tests_to_run:
+            if not any(test_id in tests for tests in implemented_tests.values()):
+                warnings.warn(f"Did not find {test_id} in implemented tests!")
 
-        with open(
+        with run_files.RunRegistry(
             Path(__file__).parents[1].resolve()
-            / f"test_data/{self.args.experiment_id}/experiment_config.json",
-            "r",
-        ) as f:
-            config = json.load(f)
-            self.config = {int(k): v for k, v in config.items()}
+            / f"test_data/{self.args.experiment_id}"
+        ) as run_registry:
+            self.config = run_registry.configs(self.conversations.keys())
 
+        """ Maps the ids of the static tests to the conversations they have scored already, which are not analysed
+        again. """
+        self.scored = {
+            test_id: {}
+            for test_id in implemented_tests["static_tests"]
+            if test_id in self.tests_to_run
+        }
         if args.export_channel == "sqlite":
             self.db_path = af.create_sqlite(args)
             self.setup_sqlite()
+            self.load_scored()
 
     def setup_sqlite(self):
-        """Method used for setting up the sqlite-database, which is based upon the table called GDMs."""
-        for run_id, _ in self.conversations.items():
-            conn = af.create_connection(self.db_path)
-            cursor = conn.cursor()
-            try:
-                cursor.execute("SELECT run_id FROM runs WHERE run_id = ?", (run_id,))
-                data = cursor.fetchall()
-                if len(data) == 0:
-                    cursor.execute(
-                        """
-                        INSERT
-                        INTO runs(run_id, testee_id, conv_partner_id, conv_length, amount_convs, conv_starter, date_time_generated, date_time_tested)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
-                        """,
-                        [
-                            run_id,
-                            self.config[run_id]["testee_id"],
-                            self.config[run_id]["conv_partner_id"],
-                            self.config[run_id]["conv_length"],
-                            self.config[run_id]["amount_convs"],
-                            self.config[run_id]["conv_starter"],
-                            self.config[run_id]["date_time"],
-                            datetime.utcnow(),
-                        ],
-                    )
-                else:
-                    cursor.execute(
-                        """
-                        UPDATE runs
-                        SET date_time_tested=?;
-                        """,
-                        [
-                            datetime.utcnow(),
-                        ],
-                    )
+        """Method used for setting up the sqlite-database, which is based upon the table called runs. The tested runs
+        are added to runs, or have their date_time_tested updated if they are in it already, in one transaction."""
+        conn = af.get_connection(self.db_path)
+        cursor = conn.cursor()
+        try:
+            run_ids = list(self.conversations.keys())
+            cursor.execute("SELECT run_id FROM runs")
+            existing_run_ids = {run_id for (run_id,) in cursor.fetchall()}
+            date_time_tested = datetime.utcnow()
+            cursor.executemany(
+                """
+                INSERT
+                INTO runs(run_id, testee_id, conv_partner_id, conv_length, amount_convs, conv_starter, date_time_generated, date_time_tested)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                """,
+                [
+                    [
+                        run_id,
+                        self.config[run_id]["testee_id"],
+                        self.config[run_id]["conv_partner_id"],
+                        self.config[run_id]["conv_length"],
+                        self.config[run_id]["amount_convs"],
+                        self.config[run_id]["conv_starter"],
+                        self.config[run_id]["date_time"],
+                        date_time_tested,
+                    ]
+                    for run_id in run_ids
+                    if run_id not in existing_run_ids
+                ],
+            )
+            cursor.executemany(
+                """
+                UPDATE runs
+                SET date_time_tested=?
+                WHERE run_id = ?;
+                """,
+                [
+                    [date_time_tested, run_id]
+                    for run_id in run_ids
+                    if run_id in existing_run_ids
+                ],
+            )
+
+            # Successful insert
+            conn.commit()
+        except Error as e:
+            conn.rollback()
+            print(e)
 
-                # Successful insert
-                conn.commit()
-            except Error as e:
-                print(e)
-            finally:
-                af.close_connection(conn)
+    def load_scored(self):
+        """Loads the content hashes of the conversations of the tested runs that the selected static tests have scored
+        already in their current versions into self.scored."""
+        run_ids = set(self.conversations.keys())
+        conn = af.get_connection(self.db_path)
+        try:
+            for test_id in self.scored:
+                rows = conn.execute(
+                    """
+                    SELECT run_id, conv_nbr, conv_hash
+                    FROM scored_conversations
+                    WHERE test_id = ? AND test_version = ?
+                    """,
+                    [test_id, load_test(test_id).test_version],
+                )
+                self.scored[test_id] = {
+                    (run_id, conv_nbr): conv_hash
+                    for run_id, conv_nbr, conv_hash in rows
+                    if run_id in run_ids
+                }
+        except Error as e:
+            print(e)
 
     def init_tests(self):
         """Central function for initiating all tests."""
@@ -90,33 +248,153 @@ class TestManager:
         self.init_injected_tests()
 
     def init_static_tests(self):
-        """Method for initiating the static tests, looping over them one by one and running them."""
-        for test_case in implemented_tests["static_tests"]:
-            if self.args.verbose:
-                print("Initiating {}".format(test_case))
-                start_time_tc = time.time()
-            test_case = implemented_tests["static_tests"][test_case]()
-            test_case.analyse_conversations(self.conversations)
-            self.test_results[test_case] = test_case
-            if self.args.verbose:
-                end_time_tc = time.time() - start_time_tc
-                print(
-                    "The test case took {:.2f} seconds / {:.2f} minutes / {:.2f} hours and finished at {}".format(
-                        end_time_tc,
-                        end_time_tc / 60,
-                        end_time_tc / (60**2),
-                        datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                    )
+        """Method for initiating the static tests. Runs read from their run-files are re-evaluated in
+        reeval_workers worker processes if more than one is given. Otherwise, the lightweight tests run in a worker
+        process alongside the model-based tests, which run in this process and share its threads as specified by
+        config.MODEL_TESTS_THREADS."""
+        static_tests = [
+            test_id
+            for test_id in implemented_tests["static_tests"]
+            if test_id in self.tests_to_run
+        ]
+        if (
+            isinstance(self.conversations, run_files.ConversationStream)
+            and self.args.reeval_workers > 1
+        ):
+            results = self.run_reeval(static_tests)
+        else:
+            results = self.run_static_tests(static_tests)
+
+        for test_id in static_tests:
+            self.test_results[results[test_id]] = results[test_id]
+        registry.evict()
+
+    def run_static_tests(self, test_ids):
+        """Runs the static tests test_ids, with the lightweight tests in a worker process and the model-based tests in
+        this process. Returns the test cases holding the results."""
+        lightweight = [test_id for test_id in test_ids if test_id in lightweight_tests]
+        model_based = [
+            test_id for test_id in test_ids if test_id not in lightweight_tests
+        ]
+        results = {}
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            future = None
+            if len(lightweight) > 0:
+                if self.args.verbose:
+                    print("Initiating {}".format(", ".join(lightweight)))
+                future = executor.submit(
+                    run_static_tests, lightweight, self.conversations, self.scored
+                )
+
+            if config.MODEL_TESTS_THREADS == "split" and len(model_based) > 1:
+                results.update(self.run_model_tests_split(model_based))
+            else:
+                for test_id in model_based:
+                    results[test_id] = self.run_model_test(test_id)
+
+            lightweight_results = future.result() if future is not None else {}
+            for test_id, test_results in lightweight_results.items():
+                result_dict, conv_hashes, end_time_tc = test_results
+                test_case = load_test(test_id).from_results(result_dict, conv_hashes)
+                results[test_id] = test_case
+                self.print_test_time(test_id, end_time_tc)
+        return results
+
+    def run_reeval(self, test_ids):
+        """Re-evaluates the runs that were read from their run-files, by sharding them across reeval_workers worker
+        processes, one run per shard. The results of the shards are merged here, so that this process is the only one
+        writing them to the database. Returns the test cases holding the merged results."""
+        run_ids = self.conversations.keys()
+        nbr_workers = max(1, min(self.args.reeval_workers, len(run_ids)))
+        nbr_threads = max(1, (os.cpu_count() or 1) // nbr_workers)
+        if self.args.verbose:
+            print(
+                "Initiating {} on {} runs in {} processes".format(
+                    ", ".join(test_ids), len(run_ids), nbr_workers
+                )
+            )
+
+        result_dicts = {test_id: {} for test_id in test_ids}
+        conv_hashes = {test_id: {} for test_id in test_ids}
+        durations = dict.fromkeys(test_ids, 0)
+        with ProcessPoolExecutor(
+            max_workers=nbr_workers,
+            initializer=init_reeval_worker,
+            initargs=(test_ids, nbr_threads),
+        ) as executor:
+            shards = [self.conversations.subset([run_id]) for run_id in run_ids]
+            shards_scored = [self.scored_in_run(run_id) for run_id in run_ids]
+            for shard_results in executor.map(
+                run_reeval_shard, [test_ids] * len(shards), shards, shards_scored
+            ):
+                for test_id, test_results in shard_results.items():
+                    result_dict, shard_conv_hashes, end_time_tc = test_results
+                    result_dicts[test_id].update(result_dict)
+                    conv_hashes[test_id].update(shard_conv_hashes)
+                    durations[test_id] += end_time_tc
+
+        results = {}
+        for test_id in test_ids:
+            results[test_id] = load_test(test_id).from_results(
+                result_dicts[test_id], conv_hashes[test_id]
+            )
+            self.print_test_time(test_id, durations[test_id])
+        return results
+
+    def scored_in_run(self, run_id):
+        """Returns the part of self.scored belonging to the run run_id."""
+        return {
+            test_id: {key: value for key, value in scored.items() if key[0] == run_id}
+            for test_id, scored in self.scored.items()
+        }
+
+    def run_model_test(self, test_id):
+        """Runs the model-based static test test_id in this process and returns it."""
+        if self.args.verbose:
+            print("Initiating {}".format(test_id))
+        start_time_tc = time.time()
+        test_case = load_test(test_id)()
+        test_case.scored = self.scored[test_id]
+        test_case.analyse_conversations(self.conversations)
+        test_case.shutdown()
+        self.print_test_time(test_id, time.time() - start_time_tc)
+        return test_case
+
+    def run_model_tests_split(self, test_ids):
+        """Runs the model-based static tests in test_ids at the same time, splitting torch's threads between them."""
+        import torch
+
+        nbr_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, nbr_threads // len(test_ids)))
+        try:
+            with ThreadPoolExecutor(max_workers=len(test_ids)) as executor:
+                test_cases = executor.map(self.run_model_test, test_ids)
+                return dict(zip(test_ids, test_cases))
+        finally:
+            torch.set_num_threads(nbr_threads)
+
+    def print_test_time(self, test_id, end_time_tc):
+        """Prints how long the test test_id took, if verbose printing is used."""
+        if self.args.verbose:
+            print(
+                "The test case {} took {:.2f} seconds / {:.2f} minutes / {:.2f} hours and finished at {}".format(
+                    test_id,
+                    end_time_tc,
+                    end_time_tc / 60,
+                    end_time_tc / (60**2),
+                    datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
                 )
+            )
 
     def init_injected_tests(self):
         """Method for initiating the injected tests, which loops over them one by one and first runs the injection and
         then analyses the result."""
         for test_case in implemented_tests["injected_tests"]:
-            if test_case in tests_to_run:
+            if test_case in self.tests_to_run:
                 if self.args.verbose:
                     print("Initiates {}".format(test_case))
                     start_time_tc = time.time()
+                test_case = load_test(test_case, "injected_tests")()
                 test_case.run(self.conversations)
                 test_case.analyse(self.conversations, self.db_path)
                 if self.args.verbose:
@@ -148,3 +426,4 @@ class TestManager:
                         datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
                     )
                 )
+        af.release_connection(self.db_path)
@@ -0,0 +1,78 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+
+def find_free_port(start, reserved):
+    """Returns the first port from start and upwards that is neither in reserved nor bound by another process."""
+    port = start
+    while True:
+        if port not in reserved:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                try:
+                    s.bind(("localhost", port))
+                    return port
+                except OSError:
+                    pass
+        port += 1
+
+
+class TesteePool:
+    """Runs the conversations of several testees at once, up to max_concurrent testees at a time.
+
+    Every distinct testee id is assigned its own host port, so that several dockerised testees can run side by side.
+    Runs of the same testee id share one port and container, which is kept warm between them and shut down as soon as
+    the last of them has finished.
+    """
+
+    def __init__(self, testees, testee_ids, max_concurrent=1, base_port=None):
+        self.testees = testees
+        self.testee_ids = testee_ids
+        self.max_concurrent = max(1, max_concurrent)
+        self.base_port = base_port or config.TESTEE_BASE_PORT
+        self.ports = {}
+        self.active = {}
+        self.remaining = {}
+        for testee, testee_id in zip(testees, testee_ids):
+            if testee_id not in self.ports:
+                self.ports[testee_id] = find_free_port(
+                    self.base_port, set(self.ports.values())
+                )
+            testee.set_port(self.ports[testee_id])
+            self.remaining[testee_id] = self.remaining.get(testee_id, 0) + 1
+            self.active[testee_id] = 0
+        self.setup_locks = {testee_id: threading.Lock() for testee_id in self.ports}
+
+    def acquire(self, i):
+        """Sets up testee i. Set ups of the same testee id are serialised, so that a run starting while another run of
+        the same testee id is active finds its container running and reuses it."""
+        testee_id = self.testee_ids[i]
+        with self.setup_locks[testee_id]:
+            self.active[testee_id] += 1
+            self.testees[i].setup()
+
+    def release(self, i):
+        """Shuts testee i down, keeping it warm if another run of the same testee id is active or has not started
+        yet."""
+        testee_id = self.testee_ids[i]
+        with self.setup_locks[testee_id]:
+            self.active[testee_id] -= 1
+            self.remaining[testee_id] -= 1
+            keep_warm = self.active[testee_id] > 0 or self.remaining[testee_id] > 0
+            self.testees[i].shutdown(keep_warm=keep_warm)
+
+    def run(self, job):
+        """Calls job(i, testee) for every testee, with at most max_concurrent testees running at a time, and returns
+        the results in the order of the testees."""
+
+        def run_testee(i):
+            self.acquire(i)
+            try:
+                return job(i, self.testees[i])
+            finally:
+                self.release(i)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            return list(executor.map(run_testee, range(len(self.testees))))
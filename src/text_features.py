@@ -0,0 +1,55 @@
+import re
+from collections import Counter
+
+import src.contractions as contractions
+from src.conversation import Conversation, count_sentences_within_string
+
+""" Matches word characters and apostrophes, as the RegexpTokenizer the lexical tests used before. """
+TOKEN_PATTERN = re.compile(r"[\w']+")
+
+""" Words longer than this count as long words in the readability index. """
+LONG_WORD_LENGTH = 6
+
+
+class TextFeatures:
+    """The lexical features of testee's messages in one conversation, shared by the lexical tests.
+
+    words counts the lowercased words, with contractions expanded into the words of their first meaning, e.g. "it's"
+    into "it" and "is". nbr_words and nbr_long_words are the amount of tokens and of tokens longer than
+    LONG_WORD_LENGTH characters, as written and before expanding any contractions. nbr_sentences is the amount of
+    sentences according to count_sentences_within_string.
+    """
+
+    def __init__(self, messages):
+        self.nbr_sentences = 0
+        token_counts = Counter()
+        for message in messages:
+            self.nbr_sentences += count_sentences_within_string(message)
+            token_counts.update(TOKEN_PATTERN.findall(message))
+
+        """ Everything below works on the distinct tokens rather than on every token, so that it costs next to nothing
+        compared to the tokenization above. """
+        self.nbr_words = sum(token_counts.values())
+        self.nbr_long_words = 0
+        self.words = Counter()
+        for token, count in token_counts.items():
+            if len(token) > LONG_WORD_LENGTH:
+                self.nbr_long_words += count
+            token = token.lower()
+            if token in contractions.contractions:
+                words = contractions.contractions[token].split("/")[0]
+                for word in words.split(" "):
+                    self.words[word] += count
+            else:
+                self.words[token] += count
+
+
+def get_features(conv: Conversation):
+    """Returns the text features of testee's messages in conv. They are computed once and kept on the conversation,
+    so that all lexical tests run on the same conversation tokenize it only once."""
+    if conv.text_features is None or conv.text_features[0] != len(conv.messages):
+        features = TextFeatures(
+            str(message) for message in conv if message.role == "Testee"
+        )
+        conv.text_features = (len(conv.messages), features)
+    return conv.text_features[1]
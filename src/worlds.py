@@ -1,36 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
 import config
 import src.conv_agents as conv_agents
 from src.conversation import Conversation, InterviewConversation
+from src.model_registry import registry
+import src.run_files as run_files
+from src.testee_pool import TesteePool
 from src.test_manager import TestManager
 from pathlib import Path
-import json
 
 
-def write_to_txt(text, run_id, experiment_path):
-    log_path = experiment_path / f"run_{run_id}.txt"
-    with open(log_path, "a") as f:
-        f.write(text)
-
-
-def log_config(args, run_id, testee, log_config_path):
-    try:
-        with open(log_config_path, "r") as f:
-            config = json.load(f)
-    except:
-        config = {}
-    config[run_id] = {
-        "testee_id": testee,
-        "conv_partner_id": args.conv_partner_id,
-        "random_conv_start": args.random_conv_start,
-        "conv_length": args.conv_length,
-        "amount_convs": args.amount_convs,
-        "conv_starter": args.conv_starter,
-        "date_time": str(datetime.utcnow()),
-    }
-    with open(log_config_path, "w") as f:
-        json.dump(config, f, indent=4)
+def log_config(args, testee, run_registry):
+    """Registers a run of testee with the configuration of args in run_registry, and returns its run id."""
+    return run_registry.register(
+        {
+            "testee_id": testee,
+            "conv_partner_id": args.conv_partner_id,
+            "random_conv_start": args.random_conv_start,
+            "conv_length": args.conv_length,
+            "amount_convs": args.amount_convs,
+            "conv_starter": args.conv_starter,
+            "date_time": str(datetime.utcnow()),
+        }
+    )
 
 
 class TestWorld:
@@ -62,21 +55,9 @@ class TestWorld:
             os.mkdir(self.experiment_path)
         except:
             pass
-        self.run_id = 1
-        if (self.experiment_path / f"run_{self.run_id}.txt").exists():
-            self.run_id = (
-                max(
-                    [
-                        int(f.split("_")[1].split(".")[0])
-                        for f in os.listdir(self.experiment_path)
-                        if f[-4:] != "json"
-                    ]
-                )
-                + 1
-            )
-        self.log_config_path = self.experiment_path / "experiment_config.json"
 
         self.test_manager = None
+        self.starter_pool = None
         self.conversations = {}
         self.datetime_of_run = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
@@ -112,6 +93,14 @@ class TestWorld:
             default=False,
             help="Specifies if the result database should be overwritten during computation.",
         )
+        parser.add_argument(
+            "-tr",
+            "--tests-to-run",
+            metavar="",
+            type=str,
+            default=",".join(config.tests_to_run),
+            help="""Ids of the tests to run, separated by ",". Only the selected tests and their models are loaded.""",
+        )
         parser.add_argument(
             "-cl",
             "--conv-length",
@@ -167,14 +156,59 @@ class TestWorld:
             default=False,
             help="Conversations are initialized as interview scenarios.",
         )
+        parser.add_argument(
+            "-gw",
+            "--gen-workers",
+            metavar="",
+            type=int,
+            default=config.GEN_WORKERS,
+            help="How many conversations to generate concurrently, shared by all tested GDMs.",
+        )
+        parser.add_argument(
+            "-tw",
+            "--testee-workers",
+            metavar="",
+            type=int,
+            default=config.TESTEE_WORKERS,
+            help="How many tested GDMs to generate conversations with at the same time, each on its own port.",
+        )
+        parser.add_argument(
+            "-gb",
+            "--gen-batch-size",
+            metavar="",
+            type=int,
+            default=config.GEN_BATCH_SIZE,
+            help="How many conversations every worker advances in lockstep, batching the replies of agents that "
+            "support it.",
+        )
+        parser.add_argument(
+            "-ss",
+            "--starter-seed",
+            metavar="",
+            type=int,
+            default=config.STARTER_SEED,
+            help="Seed for generating the random conversation starters. Seeded starters are reproducible and cached "
+            "between experiments.",
+        )
         parser.add_argument(
             "-rid",
             "--read-run-ids",
             metavar="",
             type=str,
             default=config.READ_RUN_IDS,
-            help="Run ids of the runs to import. No input is interpreted as such the script generates "
-            "conversations using the GDMs. Currently only miscellaneous .txt-files are supported.",
+            help="""Run ids of the runs to import, separated by ",". Ranges such as 3-7 and globs such as 1* or * are """
+            "expanded over the runs of the experiment. A run id may be followed by a conversation number, range or glob "
+            "after a colon, such as 3:100-200, to only import those conversations. No input is interpreted as such the "
+            "script generates conversations using the GDMs. Both .jsonl- and .txt-files are supported.",
+        )
+        parser.add_argument(
+            "-rw",
+            "--reeval-workers",
+            metavar="",
+            type=int,
+            default=config.REEVAL_WORKERS,
+            help="How many processes to re-evaluate the read runs in, each loading the models of the tests once. The "
+            "runs are shared between the processes and the results are written by the main process.",
         )
 
     def init_conversations(self):
@@ -182,95 +216,125 @@ class TestWorld:
         the specified GDMs in the list testees will have conversations. Each of the testees will have amount_convs
         conversations that will then be evaluated and pose the grounds for evaluation and examination."""
         if self.args.read_run_ids != "":
-            run_ids = [int(run_id) for run_id in self.args.read_run_ids.split(",")]
-            self.read_files(run_ids)
+            selection = run_files.parse_run_selection(
+                self.args.read_run_ids, self.experiment_path
+            )
+            self.read_files(list(selection), conv_nbrs=selection)
             return
 
-        for i in range(len(self.testees)):
-            testee_conversations = []
-            testee = self.testees[i]
-            testee.setup()
-            log_config(self.args, self.run_id, self.testee_ids[i], self.log_config_path)
-            for j in range(self.args.amount_convs):
-                if self.args.verbose:
-                    print("Initiating conversation {}".format(j + 1))
-                if self.args.interview_mode:
-                    conv = InterviewConversation(
-                        testee,
-                        self.conv_partner,
-                        self.run_id,
-                        self.experiment_path,
-                        self.args,
-                    )
-                else:
-                    conv = Conversation(
+        """ The random conversation starters for all conversations are generated in batches up front, in the
+        background while the first conversations are running unless they are seeded. """
+        if self.args.random_conv_start and not self.args.interview_mode:
+            from src.starters import StarterPool
+
+            self.starter_pool = StarterPool(seed=self.args.starter_seed)
+            self.starter_pool.fill_async(len(self.testees) * self.args.amount_convs)
+
+        """ Every run gets its run_id and logged configuration up front, so that runs of testees generated at the
+        same time keep the order of the testees. The run ids are allocated by the registry of the experiment, so that
+        other processes may generate runs of the same experiment at the same time. """
+        with run_files.RunRegistry(self.experiment_path) as run_registry:
+            run_ids = [
+                log_config(self.args, testee_id, run_registry)
+                for testee_id in self.testee_ids
+            ]
+            run_registry.export_json()
+
+        """ The finished conversations are appended to the run-files through one writer, which keeps every run-file
+        open until all conversations have been generated. """
+        writer = run_files.TranscriptWriter(self.experiment_path)
+        with writer, ThreadPoolExecutor(
+            max_workers=max(1, self.args.gen_workers)
+        ) as executor:
+
+            def run_testee(i, testee):
+                batch_size = max(1, self.args.gen_batch_size)
+                futures = [
+                    executor.submit(
+                        self.generate_conversations,
                         testee,
-                        self.conv_partner,
-                        self.run_id,
-                        self.experiment_path,
-                        self.args,
+                        run_ids[i],
+                        range(j, min(j + batch_size, self.args.amount_convs)),
+                        i * self.args.amount_convs + j,
                     )
-                conv = conv.initiate_conversation(
-                    self.args.conv_length, self.run_id, self.experiment_path
+                    for j in range(0, self.args.amount_convs, batch_size)
+                ]
+
+                """ The futures are collected in the order they were submitted, so that the run-file and the order of
+                the conversations stay the same regardless of how many workers are used. """
+                testee_conversations = []
+                for future in futures:
+                    for conv in future.result():
+                        writer.write(conv)
+                        testee_conversations.append(conv)
+                return testee_conversations
+
+            """ The testee pool runs up to testee_workers testees at once, each on its own port, and shares the
+            conversation workers between them. """
+            testee_pool = TesteePool(
+                self.testees, self.testee_ids, self.args.testee_workers
+            )
+            testee_conversations = testee_pool.run(run_testee)
+            for run_id, run_conversations in zip(run_ids, testee_conversations):
+                self.conversations[run_id] = run_conversations
+        self.conv_partner.shutdown()
+
+        """ Frees the generation models before the tests load theirs. """
+        registry.evict()
+
+    def generate_conversations(self, testee, run_id, conv_idxs, starter_idx):
+        """Sets up and runs a cohort of conversations between testee and the conversation partner, which are advanced
+        in lockstep. The conversations take their starters from the pool, beginning at starter_idx. Called from the
+        worker threads of init_conversations."""
+        convs = []
+        for i, conv_idx in enumerate(conv_idxs):
+            if self.args.verbose:
+                print("Initiating conversation {}".format(conv_idx + 1))
+            if self.args.interview_mode:
+                conv = InterviewConversation(
+                    testee,
+                    self.conv_partner,
+                    run_id,
+                    self.experiment_path,
+                    self.args,
+                    conv_nbr=conv_idx + 1,
+                )
+            else:
+                starter = None
+                if self.starter_pool is not None:
+                    starter = self.starter_pool.get(starter_idx + i)
+                conv = Conversation(
+                    testee,
+                    self.conv_partner,
+                    run_id,
+                    self.experiment_path,
+                    self.args,
+                    starter=starter,
+                    conv_nbr=conv_idx + 1,
                 )
-                testee_conversations.append(conv)
-                if self.args.verbose:
-                    print("Ended conversation {}".format(j + 1))
-            testee.shutdown()
-            self.conversations[self.run_id] = testee_conversations
-            self.run_id += 1
+            convs.append(conv)
+        convs = Conversation.initiate_conversations(convs, self.args.conv_length)
+        if self.args.verbose:
+            for conv_idx in conv_idxs:
+                print("Ended conversation {}".format(conv_idx + 1))
+        return convs
 
     def init_tests(self):
         """Initiates the evaluation of the conversations produced."""
         self.test_manager = TestManager(self.testee_ids, self.conversations, self.args)
         self.test_manager.init_tests()
 
-    def read_files(self, run_ids) -> list:
-        """Read files generated in the current experiment with specified ids."""
-        with open(self.experiment_path / "experiment_config.json", "r") as f:
-            config = json.load(f)
-        config = {int(k): v for k, v in config.items()}
+    def read_files(self, run_ids, conv_nbrs=None):
+        """Read files generated in the current experiment with specified ids. The conversations are not read up front,
+        but streamed from the files as the tests consume them. conv_nbrs optionally maps run ids to the conversations
+        to read of them, which are sought out through the index of the run-file."""
+        self.conversations = run_files.ConversationStream(
+            run_ids, self.experiment_path, self.args, conv_nbrs=conv_nbrs
+        )
         for run_id in run_ids:
-            run_convs = []
-            with open(self.experiment_path / f"run_{run_id}.txt", encoding="utf8") as f:
-                lines = f.readlines()
-
-                conversations = self.transform_lines_to_lists(lines)
-                testee = conv_agents.AbstractAgent(
-                    config[run_id]["testee_id"], role="Testee"
-                )
-                conv_partner = conv_agents.AbstractAgent(
-                    config[run_id]["conv_partner_id"], role="Other agent"
-                )
-                self.testee_ids.append(config[run_id]["testee_id"])
-                for conversation in conversations:
-                    conv = Conversation(
-                        testee, conv_partner, run_id, self.experiment_path, self.args,
-                    )
-                    conv.conv_from_file(
-                        list_of_msgs_str=conversation,
-                        testee=config[run_id]["testee_id"],
-                        conv_partner=config[run_id]["conv_partner_id"],
-                    )
-                    run_convs.append(conv)
-            self.conversations[run_id] = run_convs
+            self.testee_ids.append(self.conversations.testee_id(run_id))
         return self.conversations
 
-    @staticmethod
-    def transform_lines_to_lists(lines):
-        """Extracting the messages from lines and adding to a list. lines is a list of strings on the form of
-        {gdm}:{message}."""
-        conversations = []
-        conversation = []
-        for i in range(len(lines)):
-            sentence = lines[i].replace("\n", "")
-            if sentence == "####":
-                conversations.append(conversation)
-                conversation = []
-            else:
-                conversation.append(sentence)
-        return conversations
-
     def export_results(self):
         """Exports the results using the selected presentation way."""
         if self.args.verbose:
@@ -0,0 +1,66 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src import containers
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Takes longer to answer an inference than the probe of wait_until_ready waits for a connection."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(time.monotonic())
+        time.sleep(self.server.delay)
+        body = json.dumps({"text": "Hi"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(delay):
+    server = ThreadingHTTPServer(("localhost", 0), SlowHandler)
+    server.requests = []
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_slow_server_is_ready_after_one_probe():
+    server = serve(1.5)
+    try:
+        url = f"http://localhost:{server.server_port}/inference"
+        assert containers.wait_until_ready(url, timeout=5)
+        assert len(server.requests) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_busy_past_timeout_counts_as_ready():
+    server = serve(3)
+    try:
+        url = f"http://localhost:{server.server_port}/inference"
+        start = time.monotonic()
+        assert containers.wait_until_ready(url, timeout=1)
+        assert time.monotonic() - start < 2.5
+        assert len(server.requests) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_refused_connections_are_retried_until_timeout():
+    server = serve(0)
+    port = server.server_port
+    server.server_close()
+    start = time.monotonic()
+    assert not containers.wait_until_ready(
+        f"http://localhost:{port}/inference", timeout=0.5, interval=0.05
+    )
+    assert time.monotonic() - start < 2
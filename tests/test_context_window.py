@@ -0,0 +1,107 @@
+import json
+
+import pytest
+from transformers import BlenderbotSmallTokenizer, BlenderbotTokenizer
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+import src.conv_agents as conv_agents
+from src.context_window import ContextWindow
+
+MESSAGES = [
+    "Hello there, how are you?",
+    "I'm good!",
+    "What do you do ",
+    "",
+    "I work as a janitor.",
+    "Is cleaning hard?",
+    "No",
+]
+
+
+class Model:
+    def to(self, device):
+        return self
+
+
+def small_tokenizer(tmp_path):
+    """A BlenderbotSmallTokenizer without merges, whose vocabulary holds the tokens of MESSAGES."""
+    merges_file = tmp_path / "merges.txt"
+    merges_file.write_text("#version: 0.2\n")
+    vocab = {"__start__": 0, "__end__": 1, "__unk__": 2, "__null__": 3}
+    vocab_file = tmp_path / "vocab.json"
+    vocab_file.write_text(json.dumps(vocab))
+    tokens = BlenderbotSmallTokenizer(vocab_file, merges_file).tokenize(
+        "\n".join(MESSAGES)
+    )
+    for token in tokens:
+        vocab.setdefault(token.lower(), len(vocab))
+    vocab_file.write_text(json.dumps(vocab))
+    return BlenderbotSmallTokenizer(vocab_file, merges_file)
+
+
+def byte_level_tokenizer(tmp_path):
+    """A BlenderbotTokenizer without merges, whose vocabulary holds every byte."""
+    merges_file = tmp_path / "merges.txt"
+    merges_file.write_text("#version: 0.2\n")
+    vocab = {"<s>": 0, "<pad>": 1, "</s>": 2, "<unk>": 3, "<mask>": 4}
+    for char in bytes_to_unicode().values():
+        vocab[char] = len(vocab)
+    vocab_file = tmp_path / "vocab.json"
+    vocab_file.write_text(json.dumps(vocab))
+    return BlenderbotTokenizer(vocab_file, merges_file)
+
+
+@pytest.mark.parametrize(
+    "agent_class, make_tokenizer, join",
+    [
+        (conv_agents.BlenderBot90M, small_tokenizer, "\n".join),
+        (
+            conv_agents.BlenderBot400M,
+            byte_level_tokenizer,
+            lambda turns: " ".join(turn + "</s> <s>" for turn in turns)[:-8],
+        ),
+    ],
+)
+@pytest.mark.parametrize("role", ["Testee", "Other agent"])
+def test_window_equals_joined_turns(
+    monkeypatch, tmp_path, agent_class, make_tokenizer, join, role
+):
+    """The input ids of the context window equal those of the turns joined into one string, as the agents joined
+    them before they kept context windows."""
+    tokenizer = make_tokenizer(tmp_path)
+    monkeypatch.setattr(agent_class, "load_model", lambda self: Model())
+    monkeypatch.setattr(agent_class, "load_tokenizer", lambda self: tokenizer)
+    agent = agent_class("agent", role=role)
+    context = agent.new_context()
+
+    messages = []
+    for message in MESSAGES:
+        messages.append(message)
+        expected = tokenizer(join(messages[-agent.chat_memory :]))["input_ids"]
+        assert agent.context_input_ids(messages, context) == expected
+        assert agent.context_input_ids(messages, agent.new_context()) == expected
+    agent.shutdown()
+
+
+def test_separator_is_kept_by_small_tokenizer(tmp_path):
+    """The newline between two turns is only a token along with the word before it."""
+    tokenizer = small_tokenizer(tmp_path)
+    encode = lambda text: tokenizer(text, add_special_tokens=False)["input_ids"]
+    assert encode("\n") == []
+    assert len(encode("No\nNo")) > 2 * len(encode("No"))
+
+
+def test_window_encodes_each_message_once_per_position():
+    encoded = []
+
+    def encode(message, first, last):
+        encoded.append((message, first, last))
+        return [message]
+
+    context = ContextWindow(encode, 3)
+    messages = []
+    for i in range(20):
+        messages.append(str(i))
+        assert context.update(messages) == [[m] for m in messages[-3:]]
+    assert len(encoded) == len(set(encoded))
+    assert len(encoded) <= 3 * len(messages)
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+
+from src.conv_agents import AbstractAgent
+from src.conversation import Conversation
+
+ARGS = argparse.Namespace(
+    random_conv_start=True, read_run_ids="", conv_starter="testee", verbose=False
+)
+
+
+class AsyncAgent(AbstractAgent):
+    """Replies through act_async only, keeping track of how many replies are awaited at once."""
+
+    def __init__(self, agent_id, role):
+        AbstractAgent.__init__(self, agent_id=agent_id, role=role)
+        self.waiting = 0
+        self.max_waiting = 0
+
+    async def act_async(self, messages, context=None):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        await asyncio.sleep(0.01)
+        self.waiting -= 1
+        return f"{len(messages)}"
+
+
+class BatchAgent(AbstractAgent):
+    def __init__(self, agent_id, role):
+        AbstractAgent.__init__(self, agent_id=agent_id, role=role)
+        self.batch_sizes = []
+
+    def act_batch(self, messages, contexts=None):
+        self.batch_sizes.append(len(messages))
+        return [f"{len(m)}" for m in messages]
+
+
+def test_cohort_gathers_async_replies_and_batches_the_others(tmp_path):
+    testee = AsyncAgent("testee", "Testee")
+    partner = BatchAgent("partner", "Other agent")
+    convs = [
+        Conversation(testee, partner, 1, tmp_path, ARGS, starter="Hi", conv_nbr=i)
+        for i in range(1, 6)
+    ]
+    convs = Conversation.initiate_conversations(convs, 2)
+
+    assert testee.max_waiting == 5
+    assert partner.batch_sizes == [5, 5]
+    for conv in convs:
+        assert [str(m) for m in conv] == ["Hi", "1", "2", "3", "4"]
+        assert [m.role for m in conv.messages[1:]] == ["Testee", "Other agent"] * 2
+
+
+def test_finished_conversations_drop_their_caches(tmp_path):
+    testee = AsyncAgent("testee", "Testee")
+    partner = BatchAgent("partner", "Other agent")
+    conv = Conversation(testee, partner, 1, tmp_path, ARGS, starter="Hi", conv_nbr=1)
+    conv.initiate_conversation(2)
+
+    assert conv.str_messages == []
+    assert conv.context_windows == {}
+    assert conv.str_conversation() == ["Hi", "1", "2", "3", "4"]
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+
+from src.emely_client import EmelyClient
+
+
+def test_threads_share_one_executor(monkeypatch):
+    """Threads sending their first requests at once use the executor of the client, which close shuts down."""
+    client = EmelyClient("http://localhost:1/inference")
+    monkeypatch.setattr(client, "inference", lambda text: text)
+    executor = client.executor
+    barrier = threading.Barrier(8)
+    replies = []
+
+    def send(i):
+        barrier.wait()
+        replies.append(asyncio.run(client.inference_async(str(i))))
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+
+    assert client.executor is executor
+    assert sorted(replies) == [str(i) for i in range(8)]
+    assert executor._shutdown
+
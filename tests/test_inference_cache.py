@@ -0,0 +1,59 @@
+import sqlite3
+
+from src import inference_cache
+from src.inference_cache import InferenceCache
+
+
+def nbr_entries(cache):
+    (counted,) = cache.conn.execute("SELECT COUNT(*) FROM inference_cache").fetchone()
+    ((kept,),) = cache.conn.execute(
+        "SELECT nbr_entries FROM inference_cache_size"
+    ).fetchall()
+    assert kept == counted
+    return kept
+
+
+def test_size_is_kept_through_updates_and_evictions(tmp_path):
+    cache = InferenceCache("model", path=tmp_path / "cache.sqlite", max_entries=5)
+    cache.put_many({f"text {i}": i for i in range(4)})
+    assert nbr_entries(cache) == 4
+    cache.put_many({"text 0": 10, "text 1": 11})
+    assert nbr_entries(cache) == 4
+    assert cache.get_many(["text 0", "text 1"]) == {"text 0": 10, "text 1": 11}
+    cache.put_many({f"other {i}": i for i in range(3)})
+    assert nbr_entries(cache) == 5
+    assert len(cache.get_many([f"text {i}" for i in range(4)])) == 2
+    cache.close()
+
+
+def test_existing_cache_is_counted_once(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE inference_cache (key TEXT NOT NULL, model_id TEXT NOT NULL, output TEXT NOT NULL, "
+        "last_used DOUBLE NOT NULL, PRIMARY KEY (key))"
+    )
+    conn.executemany(
+        "INSERT INTO inference_cache VALUES (?, 'model', '0', 0)",
+        [(str(i),) for i in range(3)],
+    )
+    conn.commit()
+    conn.close()
+
+    for _ in range(2):
+        cache = InferenceCache("model", path=path, max_entries=10)
+        assert nbr_entries(cache) == 3
+        cache.close()
+
+
+def test_recently_used_entries_are_not_marked_again(tmp_path, monkeypatch):
+    cache = InferenceCache("model", path=tmp_path / "cache.sqlite", max_entries=10)
+    cache.put_many({"text": 1})
+    changes = cache.conn.total_changes
+    assert cache.get_many(["text"]) == {"text": 1}
+    assert cache.conn.total_changes == changes
+
+    monkeypatch.setattr(inference_cache, "LAST_USED_GRANULARITY", -1)
+    cache.get_many(["text"])
+    assert cache.conn.total_changes > changes
+    cache.close()
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from src.model_registry import ModelRegistry
+
+
+def test_entries_are_evicted_once_released():
+    registry = ModelRegistry()
+    loads = []
+    loader = lambda: loads.append(1) or object()
+
+    model = registry.acquire("model", loader, device="cpu")
+    assert registry.acquire("model", loader, device="cpu") is model
+    assert registry.is_loaded("model", device="cpu")
+    assert not registry.is_loaded("model")
+
+    registry.release("model", device="cpu")
+    assert registry.evict() == []
+    registry.release("model", device="cpu")
+    registry.release("model", device="cpu")
+    assert registry.is_loaded("model", device="cpu")
+    assert registry.evict("other") == []
+    assert registry.evict("model") == [("model", "cpu", None)]
+    assert not registry.is_loaded("model", device="cpu")
+
+    registry.acquire("model", loader, device="cpu")
+    assert len(loads) == 2
+
+
+def test_concurrent_acquires_load_once():
+    registry = ModelRegistry()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.05)
+        return object()
+
+    entries = []
+    threads = [
+        threading.Thread(target=lambda: entries.append(registry.acquire("m", loader)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert len(set(map(id, entries))) == 1
+    for _ in range(3):
+        registry.release("m")
+    assert registry.evict() == []
+    registry.release("m")
+    assert registry.evict() == [("m", None, None)]
+    assert not registry.is_loaded("m")
@@ -0,0 +1,64 @@
+import json
+
+from src import run_files
+
+
+def write_run(path, nbr_convs):
+    records = [
+        {"messages": [{"role": "Testee", "message": f"conversation {conv_nbr}"}]}
+        for conv_nbr in range(1, nbr_convs + 1)
+    ]
+    path.write_bytes(b"".join((json.dumps(r) + "\n").encode() for r in records))
+    run_files.build_index(path)
+
+
+def test_index_lacking_last_conversation_is_rebuilt(tmp_path):
+    """A run that was stopped between writing a conversation and indexing it has an index that lacks it."""
+    path = tmp_path / "run_1.jsonl"
+    write_run(path, 3)
+    index_path = run_files.index_path(path)
+    index_path.write_bytes(index_path.read_bytes()[: -run_files.INDEX_ENTRY.size])
+
+    assert run_files.count_conversations(tmp_path, 1) == 3
+    records = list(run_files.read_conversation_records(path, [2, 3]))
+    assert [conv_nbr for conv_nbr, _ in records] == [2, 3]
+    assert records[1][1][0]["message"] == "conversation 3"
+
+
+def test_index_with_partial_entry_is_rebuilt(tmp_path):
+    path = tmp_path / "run_1.jsonl"
+    write_run(path, 2)
+    index_path = run_files.index_path(path)
+    index_path.write_bytes(index_path.read_bytes()[:-1])
+    assert run_files.count_conversations(tmp_path, 1) == 2
+
+
+def test_current_index_is_kept(tmp_path):
+    path = tmp_path / "run_1.jsonl"
+    write_run(path, 2)
+    assert run_files.index_is_current(path)
+    path.with_suffix(".jsonl").write_bytes(b"")
+    assert not run_files.index_is_current(path)
+
+
+class Conv:
+    def __init__(self, run_id, message):
+        self.run_id = run_id
+        self.message = message
+
+    def to_record(self):
+        return {"messages": [{"role": "Testee", "message": self.message}]}
+
+
+def test_writer_rebuilds_stale_index_before_appending(tmp_path):
+    path = tmp_path / "run_1.jsonl"
+    write_run(path, 2)
+    index_path = run_files.index_path(path)
+    index_path.write_bytes(index_path.read_bytes()[: -run_files.INDEX_ENTRY.size])
+
+    with run_files.TranscriptWriter(tmp_path, "jsonl") as writer:
+        writer.write(Conv(1, "conversation 3"))
+    records = list(run_files.read_conversation_records(path, [1, 2, 3]))
+    assert [r[1][0]["message"] for r in records] == [
+        f"conversation {conv_nbr}" for conv_nbr in (1, 2, 3)
+    ]
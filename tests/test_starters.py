@@ -0,0 +1,27 @@
+import random
+
+import torch
+
+from src import starters
+
+
+def fake_generate_starters(prompts, batch_size=8):
+    """Draws from the random state like sampling with GPT-2 does."""
+    return [f"{prompt} {random.random()} {torch.rand(1).item()}" for prompt in prompts]
+
+
+def test_random_state_is_the_same_whether_starters_are_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(starters, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(starters, "generate_starters", fake_generate_starters)
+
+    draws = []
+    pooled = []
+    for _ in range(2):
+        pool = starters.StarterPool(seed=7)
+        pool.fill(3)
+        pooled.append(pool.starters)
+        draws.append((random.random(), torch.rand(1).item()))
+
+    assert len(list(tmp_path.iterdir())) == 1
+    assert pooled[0] == pooled[1]
+    assert draws[0] == draws[1]
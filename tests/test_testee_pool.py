@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import containers
+from src.conv_agents import Emely
+from src import testee_pool
+
+
+class EmelyHandler(BaseHTTPRequestHandler):
+    """Answers every request with the port of the server, in place of a dockerised Emely."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"text": str(self.server.server_port)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_containers(monkeypatch):
+    """Stubs out docker, starting an HTTP server per container on its host port instead."""
+    servers = {}
+    started = []
+    stopped = []
+
+    def start_container(name, image, host_port, container_port=8080):
+        if name not in servers:
+            server = ThreadingHTTPServer(("localhost", host_port), EmelyHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers[name] = server
+            started.append((name, host_port))
+        return servers[name].server_port == host_port
+
+    def stop_container(name):
+        server = servers.pop(name)
+        server.shutdown()
+        server.server_close()
+        stopped.append(name)
+
+    monkeypatch.setattr(containers, "start_container", start_container)
+    monkeypatch.setattr(containers, "stop_container", stop_container)
+    yield started, stopped
+    for name in list(servers):
+        stop_container(name)
+
+
+def test_find_free_port_skips_reserved_and_bound_ports():
+    with ThreadingHTTPServer(("localhost", 0), EmelyHandler) as server:
+        bound = server.server_port
+        assert testee_pool.find_free_port(bound, set()) != bound
+        port = testee_pool.find_free_port(bound + 1, {bound + 1})
+        assert port > bound + 1
+
+
+def test_pool_runs_testees_on_their_own_ports(monkeypatch, fake_containers):
+    started, stopped = fake_containers
+    shutdowns = []
+    shutdown = Emely.shutdown
+
+    def record_shutdown(self, keep_warm=False):
+        shutdowns.append((self.agent_id, keep_warm))
+        shutdown(self, keep_warm=keep_warm)
+
+    monkeypatch.setattr(Emely, "shutdown", record_shutdown)
+
+    testee_ids = ["emely_a", "emely_b", "emely_a", "emely_c"]
+    testees = [Emely(testee_id, role="Testee") for testee_id in testee_ids]
+    pool = testee_pool.TesteePool(testees, testee_ids, max_concurrent=2, base_port=18080)
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def job(i, testee):
+        with lock:
+            running.append(i)
+            max_running.append(len(running))
+        time.sleep(0.2)
+        reply = testee.act(["Hello"])
+        with lock:
+            running.remove(i)
+        return int(reply)
+
+    replies = pool.run(job)
+    for testee in testees:
+        testee.client.close()
+
+    ports = [pool.ports[testee_id] for testee_id in testee_ids]
+    assert replies == ports
+    assert len(set(pool.ports.values())) == 3
+    assert max(max_running) == 2
+
+    """ The two runs of emely_a share one container, which is stopped once, after the last of them. """
+    assert sorted(name for name, _ in started) == ["emely_a", "emely_b", "emely_c"]
+    assert sorted(stopped) == ["emely_a", "emely_b", "emely_c"]
+    assert [warm for name, warm in shutdowns if name == "emely_a"] == [True, False]
+    assert [warm for name, warm in shutdowns if name != "emely_a"] == [False, False]
@@ -1,4 +1,4 @@
-from src.aux_functions import create_connection, close_connection
+from src.aux_functions import create_connection, close_connection, migrate_sqlite
 from pathlib import Path
 import pandas as pd
 from sqlite3 import Error
@@ -27,11 +27,27 @@ def get_data(experiment_id: str) -> Dict[str, pd.DataFrame]:
         Dict[pd.DataFrame]: Dict with tables
     """
     db_path = Path(__file__).parents[1] / f"test_results/{experiment_id}.sqlite"
+    # Databases of experiments tested by older versions of the script are brought up to the current schema.
+    migrate_sqlite(db_path)
     conn = create_connection(db_path)
     try:
         configs = pd.read_sql("SELECT * FROM runs", conn)
-        tox = pd.read_sql("SELECT * FROM TOX_results", conn)
-        vocsz = pd.read_sql("SELECT * FROM VOCSZ_results", conn)
+        tox = pd.read_sql(
+            """
+            SELECT r.run_id, r.conv_nbr, r.msg_nbr, t.toxicity_type, r.toxicity_level
+            FROM TOX_results r
+            JOIN toxicity_types t USING (toxicity_type_id)
+            """,
+            conn,
+        )
+        vocsz = pd.read_sql(
+            """
+            SELECT r.run_id, r.conv_nbr, w.word, r.word_rank, r.frequency
+            FROM VOCSZ_results r
+            JOIN words w USING (word_id)
+            """,
+            conn,
+        )
         coher = pd.read_sql("SELECT * FROM COHER_results", conn)
         readind = pd.read_sql("SELECT * FROM READIND_results", conn)
     except Error as e: